@@ -0,0 +1,62 @@
+""" Benchmark of building the stacked slice query matrix used by the PGD strategies,
+comparing the per-workload COO build + torch_cat_sparse_coo against the direct CSR build
+and the matrix-free KroneckerQueryOperator """
+import time
+
+import numpy as np
+import pandas as pd
+import torch
+
+from dp_relational.lib.dataset import Table, RelationalDataset
+from dp_relational.lib.qm import QueryManagerTorch
+from dp_relational.lib.helpers import torch_cat_sparse_coo
+
+n_rows = 2000
+n_relationships = 20000
+subtable_size = 1_000_000
+num_workloads = 15
+
+rng = np.random.default_rng(0)
+df1 = pd.DataFrame({"ID": np.arange(n_rows), **{f"a{i}": rng.integers(0, 3 + i, n_rows) for i in range(4)}})
+df2 = pd.DataFrame({"ID": np.arange(n_rows), **{f"b{i}": rng.integers(0, 2 + i, n_rows) for i in range(4)}})
+df_rel = pd.DataFrame({"ID1": rng.integers(0, n_rows, n_relationships), "ID2": rng.integers(0, n_rows, n_relationships)})
+rel_dataset = RelationalDataset(Table(df1, "ID"), Table(df2, "ID"), df_rel, "ID1", "ID2", dmax=50)
+qm = QueryManagerTorch(rel_dataset, 3, rel_dataset.table1.df, rel_dataset.table2.df)
+
+slice_size = int(np.sqrt(subtable_size))
+slice_table1 = torch.randperm(n_rows)[:slice_size]
+slice_table2 = torch.randperm(n_rows)[:slice_size]
+workloads = qm.workload_names[:num_workloads]
+
+time_start = time.perf_counter()
+Q_coo = torch.empty((0, slice_size * slice_size)).to_sparse_coo().float().coalesce()
+for workload in workloads:
+    curr_Qmat, _ = qm.get_query_mat_sub_table(workload, slice_table1, slice_table2)
+    Q_coo = torch_cat_sparse_coo([Q_coo, curr_Qmat])
+coo_time = time.perf_counter() - time_start
+
+time_start = time.perf_counter()
+Q_csr, _ = qm.get_query_mat_sub_table_stacked(workloads, slice_table1, slice_table2)
+csr_time = time.perf_counter() - time_start
+
+time_start = time.perf_counter()
+Q_op, _ = qm.get_query_operator_sub_table(workloads, slice_table1, slice_table2)
+op_time = time.perf_counter() - time_start
+
+# all three must agree on Q @ b and Q.T @ r
+b = torch.rand(slice_size * slice_size, 1)
+r = torch.rand(Q_coo.size(0), 1)
+assert torch.allclose(torch.sparse.mm(Q_coo, b), Q_csr @ b, rtol=1e-4)
+assert torch.allclose(torch.sparse.mm(Q_coo.t(), r), Q_csr.T @ r, rtol=1e-4)
+assert torch.allclose(Q_csr @ b, Q_op @ b, rtol=1e-4)
+assert torch.allclose(Q_csr.T @ r, Q_op.T @ r, rtol=1e-4)
+
+def time_products(Q):
+    time_start = time.perf_counter()
+    Q.T @ (Q @ b)
+    return time.perf_counter() - time_start
+
+print(f"subtable_size: {slice_size * slice_size}, workloads: {num_workloads}, queries: {Q_coo.size(0)}")
+print(f"COO + torch_cat_sparse_coo: build {coo_time:.3f}s, Q.T @ (Q @ b) {time_products(Q_coo):.3f}s")
+print(f"direct CSR:                 build {csr_time:.3f}s, Q.T @ (Q @ b) {time_products(Q_csr):.3f}s")
+print(f"KroneckerQueryOperator:     build {op_time:.3f}s, Q.T @ (Q @ b) {time_products(Q_op):.3f}s")
@@ -0,0 +1,201 @@
+""" Columnar on-disk format for the artifacts saved by ModelRunner.
+
+Every artifact is a directory holding a JSON manifest and one .npy file per array, so arrays can be
+memory-mapped on load and the manifest of a run can be read without touching its error arrays.
+Columns of numeric dtype are stored as they are; any other column is stored as integer codes plus
+the list of its values in the manifest (see to_json for values JSON cannot represent). """
+
+import base64
+import json
+import os
+import pickle
+import uuid
+
+import numpy as np
+import pandas as pd
+
+from .dataset import Table, RelationalDataset
+
+MANIFEST_FILE = "manifest.json"
+FORMAT_VERSION = 1
+
+JSON_TYPES = (str, int, float, bool, type(None))
+
+def to_json(value):
+    """
+    Converts value to plain JSON data that from_json turns back into an equal value. Tuples, sets,
+    arrays, UUIDs and dicts whose keys are not all strings are tagged; any other object that JSON
+    cannot represent is pickled (and raises here if it cannot be pickled).
+    """
+    if isinstance(value, JSON_TYPES):
+        return value
+    if isinstance(value, np.generic):
+        return value.item()
+    if isinstance(value, list):
+        return [to_json(item) for item in value]
+    if isinstance(value, tuple):
+        return {"__tuple__": [to_json(item) for item in value]}
+    if isinstance(value, (set, frozenset)):
+        return {"__set__": [to_json(item) for item in value]}
+    if isinstance(value, dict):
+        if all(isinstance(key, str) for key in value):
+            return {key: to_json(item) for key, item in value.items()}
+        return {"__items__": [[to_json(key), to_json(item)] for key, item in value.items()]}
+    if isinstance(value, uuid.UUID):
+        return {"__uuid__": str(value)}
+    if isinstance(value, np.ndarray) and value.dtype != object:
+        return {"__ndarray__": value.tolist(), "dtype": value.dtype.str}
+    return {"__pickle__": base64.b64encode(pickle.dumps(value, protocol=4)).decode("ascii")}
+
+def from_json(obj):
+    """ object_hook for json.load, undoing to_json """
+    if len(obj) == 1:
+        (tag, content), = obj.items()
+        if tag == "__uuid__":
+            return uuid.UUID(content)
+        if tag == "__tuple__":
+            return tuple(content)
+        if tag == "__set__":
+            return set(content)
+        if tag == "__items__":
+            return {key: item for key, item in content}
+        if tag == "__pickle__":
+            return pickle.loads(base64.b64decode(content))
+    if set(obj.keys()) == {"__ndarray__", "dtype"}:
+        return np.array(obj["__ndarray__"], dtype=np.dtype(obj["dtype"]))
+    return obj
+
+def write_manifest(path, manifest):
+    os.makedirs(path, exist_ok=True)
+    manifest = dict(manifest, format_version=FORMAT_VERSION)
+    tmp_path = os.path.join(path, MANIFEST_FILE + ".tmp")
+    with open(tmp_path, "w") as file_out:
+        json.dump(to_json(manifest), file_out)
+    # the manifest is written last and moved into place, so a directory with a manifest is complete
+    os.replace(tmp_path, os.path.join(path, MANIFEST_FILE))
+
+def read_manifest(path):
+    with open(os.path.join(path, MANIFEST_FILE), "r") as file_in:
+        return json.load(file_in, object_hook=from_json)
+
+def is_artifact(path):
+    return os.path.isfile(os.path.join(path, MANIFEST_FILE))
+
+def save_array(path, name, array):
+    np.save(os.path.join(path, f"{name}.npy"), np.ascontiguousarray(array))
+    return f"{name}.npy"
+
+def load_array(path, fname, mmap_mode="r"):
+    return np.load(os.path.join(path, fname), mmap_mode=mmap_mode)
+
+def save_dataframe(path, df, prefix="col"):
+    """ Saves the columns of df as .npy files in path; returns the manifest entry describing them """
+    os.makedirs(path, exist_ok=True)
+    columns = []
+    for i, col in enumerate(df.columns):
+        values = df[col]
+        entry = {"name": col}
+        if pd.api.types.is_numeric_dtype(values.dtype) or pd.api.types.is_bool_dtype(values.dtype):
+            entry["file"] = save_array(path, f"{prefix}{i}", values.to_numpy())
+        else:
+            codes, uniques = pd.factorize(values, use_na_sentinel=False)
+            entry["file"] = save_array(path, f"{prefix}{i}", codes.astype(np.int32))
+            entry["values"] = uniques.tolist()
+        columns.append(entry)
+    return {"columns": columns, "n_rows": len(df.index)}
+
+def load_dataframe(path, entry, mmap_mode="r"):
+    data = {}
+    for column in entry["columns"]:
+        values = load_array(path, column["file"], mmap_mode=mmap_mode)
+        if "values" in column:
+            values = np.asarray(column["values"], dtype=object)[values]
+        data[column["name"]] = values
+    return pd.DataFrame(data, index=pd.RangeIndex(entry["n_rows"]), columns=[c["name"] for c in entry["columns"]])
+
+def _save_lookup(path, name, lookup):
+    """ A {value: code} lookup is stored as its values in code order """
+    values = list(lookup.keys())
+    assert list(lookup.values()) == list(range(len(values)))
+    values_array = np.asarray(values)
+    if len(values) > 0 and values_array.dtype.kind in "biuf":
+        return {"file": save_array(path, name, values_array)}
+    return {"values": values}
+
+def _load_lookup(path, entry):
+    values = load_array(path, entry["file"], mmap_mode=None).tolist() if "file" in entry else entry["values"]
+    return {value: code for code, value in enumerate(values)}
+
+def _save_table(path, table, prefix):
+    lookups = {col: _save_lookup(path, f"{prefix}_lookup{i}", lookup)
+               for i, (col, lookup) in enumerate(table.column_lookups.items())}
+    return {
+        "id_col": table.id_col,
+        "columns": list(table.column_index.keys()),
+        "codes": save_array(path, f"{prefix}_codes", table.codes),
+        "lookups": [[col, entry] for col, entry in lookups.items()],
+    }
+
+def _load_table(path, entry, mmap_mode):
+    codes = load_array(path, entry["codes"], mmap_mode=mmap_mode)
+    column_index = {col: i for i, col in enumerate(entry["columns"])}
+    column_lookups = {col: _load_lookup(path, lookup) for col, lookup in entry["lookups"]}
+    return Table.from_encoded(codes, column_index, column_lookups, entry["id_col"])
+
+def save_dataset(path, rel_dataset: RelationalDataset):
+    """ Saves an encoded relational dataset: the code matrix and lookups of each table, and the edge array """
+    if getattr(rel_dataset, "edges", None) is None:
+        rel_dataset.make_arrays()
+    os.makedirs(path, exist_ok=True)
+    write_manifest(path, {
+        "kind": "rel_dataset",
+        "table1": _save_table(path, rel_dataset.table1, "table1"),
+        "table2": _save_table(path, rel_dataset.table2, "table2"),
+        "edges": save_array(path, "edges", rel_dataset.edges),
+        "rel_id1_col": rel_dataset.rel_id1_col,
+        "rel_id2_col": rel_dataset.rel_id2_col,
+        "dmax": rel_dataset.dmax,
+    })
+
+def load_dataset(path, mmap_mode="r"):
+    manifest = read_manifest(path)
+    return RelationalDataset.from_encoded(
+        _load_table(path, manifest["table1"], mmap_mode), _load_table(path, manifest["table2"], mmap_mode),
+        load_array(path, manifest["edges"], mmap_mode=mmap_mode),
+        manifest["rel_id1_col"], manifest["rel_id2_col"], dmax=manifest["dmax"])
+
+def save_tables(path, dfs, kind="tables"):
+    """ Saves a list of DataFrames (e.g. the two synthetic tables, or a relationship table) """
+    os.makedirs(path, exist_ok=True)
+    write_manifest(path, {
+        "kind": kind,
+        "tables": [save_dataframe(path, df, prefix=f"t{i}_col") for i, df in enumerate(dfs)],
+    })
+
+def load_tables(path, mmap_mode="r"):
+    manifest = read_manifest(path)
+    return [load_dataframe(path, entry, mmap_mode=mmap_mode) for entry in manifest["tables"]]
+
+def save_run(path, run):
+    """ Saves a run result: everything but the error arrays goes to the manifest """
+    os.makedirs(path, exist_ok=True)
+    manifest = {key: value for key, value in run.items() if key != "errors"}
+    errors = run.get("errors")
+    if errors is not None:
+        manifest["errors"] = {
+            "file": save_array(path, "errors", np.concatenate(errors) if len(errors) > 0 else np.empty(0)),
+            "splits": np.cumsum([len(e) for e in errors])[:-1].tolist(),
+        }
+    write_manifest(path, dict(manifest, kind="run"))
+
+def load_run_errors(path, entry, mmap_mode="r"):
+    """ The per-workload error arrays of a run, as views of one memory-mapped array """
+    return np.split(load_array(path, entry["file"], mmap_mode=mmap_mode), entry["splits"])
+
+def load_run(path, load_errors=True, mmap_mode="r"):
+    manifest = read_manifest(path)
+    manifest.pop("format_version", None)
+    manifest.pop("kind", None)
+    if "errors" in manifest:
+        manifest["errors"] = load_run_errors(path, manifest["errors"], mmap_mode=mmap_mode) if load_errors else None
+    return manifest
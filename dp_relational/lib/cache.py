@@ -0,0 +1,224 @@
+""" Content-addressed on-disk cache for the stages of a ModelRunner run.
+
+Each stage output is stored under a key that hashes the inputs of the stage (and the keys of the
+stages it depends on), so a run automatically reuses anything that was already computed from the
+same inputs. Entries live in one directory per stage; the least recently used entries are evicted
+once the store grows beyond its size limit. """
+
+import functools
+import hashlib
+import os
+import pickle
+import shutil
+import tempfile
+import types
+
+import numpy as np
+import pandas as pd
+
+import torch
+
+# simple values referenced as globals by a hashed function are part of its fingerprint
+SIMPLE_TYPES = (type(None), bool, int, float, complex, str, bytes, np.generic, torch.device, torch.dtype)
+
+def _update_fingerprint(h, obj, seen):
+    """ Feeds a canonical encoding of obj into the hash h """
+    if isinstance(obj, SIMPLE_TYPES):
+        h.update(f"{type(obj).__name__}:{obj!r};".encode())
+    elif isinstance(obj, (list, tuple)):
+        h.update(f"{type(obj).__name__}[{len(obj)}](".encode())
+        for item in obj:
+            _update_fingerprint(h, item, seen)
+        h.update(b")")
+    elif isinstance(obj, dict):
+        h.update(f"dict[{len(obj)}](".encode())
+        for key in sorted(obj, key=repr):
+            _update_fingerprint(h, key, seen)
+            _update_fingerprint(h, obj[key], seen)
+        h.update(b")")
+    elif isinstance(obj, np.ndarray):
+        h.update(f"ndarray:{obj.dtype.str}:{obj.shape};".encode())
+        h.update(np.ascontiguousarray(obj).tobytes())
+    elif isinstance(obj, pd.DataFrame):
+        h.update(f"DataFrame:{list(obj.columns)!r}:{[str(t) for t in obj.dtypes]!r};".encode())
+        h.update(pd.util.hash_pandas_object(obj, index=True).values.tobytes())
+    elif isinstance(obj, types.ModuleType):
+        h.update(f"module:{obj.__name__};".encode())
+    elif isinstance(obj, types.CodeType):
+        h.update(obj.co_code)
+        _update_fingerprint(h, obj.co_names, seen)
+        for const in obj.co_consts:
+            _update_fingerprint(h, const, seen)
+    elif isinstance(obj, types.FunctionType):
+        if id(obj) in seen:
+            h.update(f"function-ref:{obj.__qualname__};".encode())
+            return
+        seen.add(id(obj))
+        h.update(f"function:{obj.__module__}.{obj.__qualname__};".encode())
+        _update_fingerprint(h, obj.__code__, seen)
+        _update_fingerprint(h, obj.__defaults__, seen)
+        _update_fingerprint(h, obj.__kwdefaults__, seen)
+        _update_fingerprint(h, [cell.cell_contents for cell in (obj.__closure__ or ())], seen)
+        # globals the function reads, e.g. hyperparameters set at the top of an experiment script
+        referenced = {name: obj.__globals__[name] for name in _referenced_names(obj.__code__)
+                      if name in obj.__globals__}
+        for name in sorted(referenced):
+            value = referenced[name]
+            if isinstance(value, SIMPLE_TYPES) or isinstance(value, types.FunctionType):
+                _update_fingerprint(h, name, seen)
+                _update_fingerprint(h, value, seen)
+    elif callable(obj) and hasattr(obj, "__qualname__"):
+        h.update(f"callable:{getattr(obj, '__module__', '')}.{obj.__qualname__};".encode())
+    else:
+        # anything else is keyed by its pickle; unpicklable objects fall back to their type and repr
+        try:
+            h.update(pickle.dumps(obj, protocol=4))
+        except Exception:
+            h.update(f"{type(obj).__qualname__}:{obj!r};".encode())
+
+def _referenced_names(code):
+    names = set(code.co_names)
+    for const in code.co_consts:
+        if isinstance(const, types.CodeType):
+            names |= _referenced_names(const)
+    return names
+
+def fingerprint(*inputs):
+    """ Hex digest identifying the given stage inputs """
+    h = hashlib.sha256()
+    _update_fingerprint(h, inputs, set())
+    return h.hexdigest()
+
+@functools.lru_cache(maxsize=None)
+def library_fingerprint():
+    """ Hex digest of the source of the dp_relational package. Stage keys include it, since the hashed
+    generator and strategy functions call into library code (datasets, query managers, synthesizers)
+    whose changes would otherwise not invalidate cached outputs. """
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    h = hashlib.sha256()
+    for dirpath, dirnames, fnames in os.walk(root):
+        dirnames[:] = sorted(d for d in dirnames if not d.startswith((".", "__")))
+        for fname in sorted(fnames):
+            if fname.endswith(".py"):
+                fpath = os.path.join(dirpath, fname)
+                h.update(os.path.relpath(fpath, root).encode())
+                with open(fpath, "rb") as file_in:
+                    h.update(file_in.read())
+    return h.hexdigest()
+
+class ArtifactCache:
+    """
+    A directory of pickled stage outputs (or, for put_dir, directories of files), one subdirectory
+    per stage, keyed by fingerprint().
+    Reading an entry marks it as recently used; once the store is larger than max_bytes the
+    least recently used entries are deleted.
+    """
+    def __init__(self, root, max_bytes=16 * 2**30):
+        self.root = root
+        self.max_bytes = max_bytes
+
+    def path(self, stage, key):
+        return os.path.join(self.root, stage, f"{key}.pkl")
+
+    def get(self, stage, key):
+        """ Returns (True, value) for a cached entry, or (False, None) """
+        fpath = self.path(stage, key)
+        try:
+            with open(fpath, "rb") as file_in:
+                value = pickle.load(file_in)
+        except (FileNotFoundError, EOFError, pickle.UnpicklingError):
+            return False, None
+        try:
+            os.utime(fpath)
+        except FileNotFoundError:
+            pass
+        return True, value
+
+    def put(self, stage, key, value):
+        fpath = self.path(stage, key)
+        os.makedirs(os.path.dirname(fpath), exist_ok=True)
+        # written to a temporary file first, so concurrent runs never read a partial entry
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(fpath), suffix=".tmp")
+        try:
+            with os.fdopen(fd, "wb") as file_out:
+                pickle.dump(value, file_out, protocol=4)
+            os.replace(tmp_path, fpath)
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+        self.evict()
+
+    def dir_path(self, stage, key):
+        return os.path.join(self.root, stage, key)
+
+    def get_dir(self, stage, key):
+        """ Path of a cached directory entry (see put_dir), or None """
+        dpath = self.dir_path(stage, key)
+        if not os.path.isdir(dpath):
+            return None
+        try:
+            os.utime(dpath)
+        except FileNotFoundError:
+            return None
+        return dpath
+
+    def put_dir(self, stage, key, write):
+        """ Stores a directory entry, for artifacts that are read back as several files (e.g. memory
+        maps). write(path) fills a fresh directory, which is then moved into place. """
+        dpath = self.dir_path(stage, key)
+        os.makedirs(os.path.dirname(dpath), exist_ok=True)
+        tmp_path = tempfile.mkdtemp(dir=os.path.dirname(dpath), suffix=".tmp")
+        try:
+            write(tmp_path)
+            os.replace(tmp_path, dpath)
+        except OSError:
+            # another run stored the same entry first
+            if not os.path.isdir(dpath):
+                raise
+        finally:
+            if os.path.exists(tmp_path):
+                shutil.rmtree(tmp_path)
+        self.evict()
+        return dpath
+
+    def entries(self):
+        """ (mtime, size, path) of every entry in the store """
+        found = []
+        if not os.path.isdir(self.root):
+            return found
+        for stage in os.listdir(self.root):
+            stage_dir = os.path.join(self.root, stage)
+            if not os.path.isdir(stage_dir):
+                continue
+            for fname in os.listdir(stage_dir):
+                if fname.endswith(".tmp"):
+                    continue
+                fpath = os.path.join(stage_dir, fname)
+                try:
+                    stat = os.stat(fpath)
+                    size = stat.st_size
+                    if os.path.isdir(fpath):
+                        size = sum(os.path.getsize(os.path.join(fpath, f)) for f in os.listdir(fpath))
+                except FileNotFoundError:
+                    continue
+                found.append((stat.st_mtime, size, fpath))
+        return found
+
+    def evict(self):
+        """ Deletes least recently used entries until the store fits in max_bytes """
+        if self.max_bytes is None:
+            return
+        entries = sorted(self.entries())
+        total = sum(size for _, size, _ in entries)
+        for _, size, fpath in entries:
+            if total <= self.max_bytes:
+                break
+            try:
+                if os.path.isdir(fpath):
+                    shutil.rmtree(fpath)
+                else:
+                    os.remove(fpath)
+            except FileNotFoundError:
+                pass
+            total -= size
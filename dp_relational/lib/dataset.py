@@ -2,7 +2,52 @@
 Contains classes for data management
 """
 import numpy as np
-from tqdm import tqdm
+import pandas as pd
+
+def compact_int_dtype(num_values):
+    """Returns the narrowest unsigned integer dtype that can hold codes 0..num_values-1"""
+    for dtype in (np.uint8, np.uint16, np.uint32):
+        if num_values <= np.iinfo(dtype).max + 1:
+            return np.dtype(dtype)
+    return np.dtype(np.uint64)
+
+def encode_columns(df, columns, keep_order=()):
+    """Encodes the given columns of df as compact integer codes in a single columnar pass.
+    
+    Returns a new DataFrame (with every other column untouched) and a dict mapping each
+    encoded column to its {value: code} lookup. Codes are assigned in sorted value order,
+    except for columns in keep_order, which are coded in order of first appearance: for a
+    unique id column this makes each row's code equal to its position in the table. These codes
+    differ from those of make_unique_ints, which followed set iteration order."""
+    encoded = {}
+    column_lookups = {}
+    for col in df.columns:
+        if col not in columns:
+            encoded[col] = df[col].values
+            continue
+        codes, uniques = pd.factorize(df[col], sort=col not in keep_order, use_na_sentinel=False)
+        encoded[col] = codes.astype(compact_int_dtype(len(uniques)))
+        column_lookups[col] = {value: code for code, value in enumerate(uniques.tolist())}
+    return pd.DataFrame(encoded, index=df.index), column_lookups
+
+def make_code_matrix(df):
+    """Stacks the encoded columns of df into one contiguous (n_columns, n_rows) matrix of the
+    narrowest integer dtype that holds every code, so that each column is a contiguous row.
+    Returns the matrix and a dict from column name to its row in the matrix."""
+    column_index = {col: i for i, col in enumerate(df.columns)}
+    max_code = max((int(df[col].max()) for col in df.columns if len(df.index) > 0), default=0)
+    dtype = compact_int_dtype(max_code + 1)
+    codes = np.empty((len(df.columns), len(df.index)), dtype=dtype)
+    for col, i in column_index.items():
+        codes[i] = df[col].values
+    return codes, column_index
+
+def make_edge_array(df_rel, id1_col, id2_col):
+    """Returns the relationships in df_rel as a contiguous (n_relationships, 2) int32 array"""
+    edges = np.empty((len(df_rel.index), 2), dtype=np.int32)
+    edges[:, 0] = df_rel[id1_col].values
+    edges[:, 1] = df_rel[id2_col].values
+    return edges
 
 def make_unique_ints(df, col):
     unique_ids = set(i[col]
@@ -12,12 +57,16 @@ def make_unique_ints(df, col):
     return new_col, ids_to_ints
 
 def map_unique_ints(df, col, ids_to_ints):
-    new_col = [ids_to_ints[i] for i in df[col]]
-    return new_col
+    lookup = pd.Index(list(ids_to_ints.keys()))
+    positions = lookup.get_indexer(df[col])
+    if np.any(positions < 0):
+        raise KeyError(f"{col} contains values missing from the lookup")
+    codes = np.fromiter(ids_to_ints.values(), dtype=np.int64, count=len(ids_to_ints))
+    return codes[positions]
 
 def remove_excess_rows(df, column, k):
     counts = df.groupby(column).cumcount()
-    return df[counts < k].reset_index()
+    return df[counts < k].reset_index(drop=True)
 
 class Table:
     def __init__(self, df, id_col, do_onehot_encode=None):
@@ -25,32 +74,50 @@ class Table:
         self.id_col = id_col
         self.col_dict = None # created by make_column_dict
         
-        columns_to_encode = do_onehot_encode
+        columns_to_encode = None if do_onehot_encode is None else list(do_onehot_encode)
         if columns_to_encode is None:
             # encode all columns
             columns_to_encode = []
             for col in self.df.columns:
-                if col is not id_col:
+                if col != id_col:
                     columns_to_encode.append(col)
         if id_col is not None:
             columns_to_encode.append(id_col)
         
-        self.column_lookups = {}
-        for column in tqdm(columns_to_encode):
-            self.df[column], self.column_lookups[column] = make_unique_ints(self.df, column)
+        self.df, self.column_lookups = encode_columns(self.df, columns_to_encode, keep_order=(id_col,))
+        
+        self.codes = None # created by make_code_matrix
+        self.column_index = None
         
+    @classmethod
+    def from_encoded(cls, codes, column_index, column_lookups, id_col):
+        """Rebuilds an already encoded table from its code matrix (see make_code_matrix) and
+        lookups, without encoding it again. codes may be a memory map."""
+        table = cls.__new__(cls)
+        table.id_col = id_col
+        table.df = pd.DataFrame({col: codes[i] for col, i in column_index.items()}, copy=False)
+        table.column_lookups = column_lookups
+        table.codes = codes
+        table.column_index = column_index
+        table.make_column_dict()
+        return table
+    
     def make_column_dict(self):
         """Calculates a column dict for the columns in the table, storing the number of
         unique values and their identities"""
         self.col_dict = {col: 
                 {'unique_values': list(np.sort(self.df[col].unique())), 'count': len(self.df[col].unique())} 
             for col in self.df.columns}
+    
+    def make_code_matrix(self):
+        """Stores the encoded table as a single contiguous column matrix (see make_code_matrix)"""
+        self.codes, self.column_index = make_code_matrix(self.df)
 
 class RelationalDataset:
     def __init__(self, table1: Table, table2: Table, df_rel, rel_id1_col, rel_id2_col, dmax=10) -> None:
         # prepare the cross table
-        df_rel[rel_id1_col] = map_unique_ints(df_rel, rel_id1_col, table1.column_lookups[table1.id_col])
-        df_rel[rel_id2_col] = map_unique_ints(df_rel, rel_id2_col, table2.column_lookups[table2.id_col])
+        df_rel[rel_id1_col] = map_unique_ints(df_rel, rel_id1_col, table1.column_lookups[table1.id_col]).astype(np.int32)
+        df_rel[rel_id2_col] = map_unique_ints(df_rel, rel_id2_col, table2.column_lookups[table2.id_col]).astype(np.int32)
         df_rel = df_rel[[rel_id1_col, rel_id2_col]]
         # drop id columns from tables, they are no longer needed
         table1.df = table1.df.drop(table1.id_col, axis=1)
@@ -74,4 +141,27 @@ class RelationalDataset:
         # make column dicts for the first two tables
         table1.make_column_dict()
         table2.make_column_dict()
+        
+        self.make_arrays()
+    
+    @classmethod
+    def from_encoded(cls, table1: Table, table2: Table, edges, rel_id1_col, rel_id2_col, dmax=10):
+        """Rebuilds a dataset from encoded tables (see Table.from_encoded) and its (n_relationships, 2)
+        edge array, which already has the id mapping and dmax limit applied."""
+        rel_dataset = cls.__new__(cls)
+        rel_dataset.table1 = table1
+        rel_dataset.table2 = table2
+        rel_dataset.df_rel = pd.DataFrame({rel_id1_col: edges[:, 0], rel_id2_col: edges[:, 1]})
+        rel_dataset.rel_id1_col = rel_id1_col
+        rel_dataset.rel_id2_col = rel_id2_col
+        rel_dataset.dmax = dmax
+        rel_dataset.edges = edges
+        return rel_dataset
+    
+    def make_arrays(self):
+        """Builds the compact array representation used by the query managers: a code
+        matrix for each table and an (n_relationships, 2) int32 edge array."""
+        self.table1.make_code_matrix()
+        self.table2.make_code_matrix()
+        self.edges = make_edge_array(self.df_rel, self.rel_id1_col, self.rel_id2_col)
         
\ No newline at end of file
@@ -4,15 +4,17 @@
 # code from https://github.com/terranceliu/dp-query-release
 
 import math
+import time
 import torch
 from typing import List
+from collections import OrderedDict
 
 import numpy as np
+import scipy.sparse
 
 import mosek
 import mosek.fusion
 
-from torch.distributions import OneHotCategorical
 
 """
 Functions for converting between concentrated and approximate DP
@@ -242,76 +244,40 @@ def unbiased_sample_torch(b_in, m, device="cpu"):
     
     # Create a shuffle of the bs
     shuffle = torch.randperm(n)
-    b = b_in[shuffle]
+    b = b_in[shuffle].to(device=device, dtype=torch.float64)
 
     # there is technically an annoying projection step here...
     # we need to:
     # - bring b into a clamped range
     # - make sure that b's sum is correct...
-    b = torch.clamp(b, 0, 1) # correctly clamped
     b_sum = torch.sum(b)
-
     if b_sum > float(m):
         b *= (float(m) / b_sum)
-    
+    elif b_sum < float(m):
+        # raise every entry towards 1 in proportion to its headroom
+        headroom = 1 - b
+        b += (float(m) - b_sum) * headroom / torch.sum(headroom)
+    
+    # systematic sampling: with a single uniform offset u, entry i is selected when a point
+    # u + k (k = 0..m-1) falls in its cumsum interval, i.e. when floor(cumsum - u) steps up.
+    # Every entry is selected with probability b_i and exactly m are selected.
     b_cumsum = torch.cumsum(b, dim=0)
-    indexes = [0]
-    prev_val = 0
-    while indexes[-1] != len(b):
-        next_idx = torch.searchsorted(b_cumsum, prev_val + 1, side='right') - 1
-        if (next_idx + 1) == indexes[-1]:
-            next_idx += 1
-        # print(next_idx, len(b), b_cumsum[next_idx], b_cumsum[next_idx + 1], b_cumsum[next_idx + 2])
-        indexes.append(next_idx + 1)
-        prev_val = b_cumsum[next_idx]
-        
-    #print(b, m, indexes)
-    indexes = torch.tensor(indexes, dtype=int, device=device)
-    
-    # we now have a list of indices to sample from
-    # get their sizes and choose the one to exclude
-    prob_sizes = b_cumsum[indexes[1:] - 1]
-    prob_sizes[1:] -= b_cumsum[indexes[1:-1] - 1]
-    p_sizes_cumsum = torch.cumsum(prob_sizes, dim=0)
-    
-    # parallelized sampling
-    samples = torch.rand(*prob_sizes.shape, device=device) * prob_sizes
-    samples[1:] += p_sizes_cumsum[:-1]
-    indexes_sampled = torch.searchsorted(b_cumsum, samples)
-    # so the issue is that sometimes the indexs will be outside of the range
-    indexes_sampled = torch.clamp(indexes_sampled, indexes[:-1], indexes[1:] - 1)
+    b_cumsum[-1] = float(m) # nudge for finite precision errors
+    u = torch.rand(1, dtype=torch.float64, device=device)
+    steps = torch.diff(torch.floor(b_cumsum - u), prepend=torch.floor(-u))
     
-    result = torch.zeros(*b.shape, dtype=torch.int, device=device)
-    result[indexes_sampled] = 1
-    sampled_sum = torch.sum(result)
-    # now go and delete some of them
-    deletion_probs = 1 - prob_sizes
-    
-    num_to_delete = len(prob_sizes) - m
-    deleted_indices = torch.nonzero(unbiased_sample_torch(deletion_probs, num_to_delete, device=device), as_tuple=True)[0]
-    #print("delind", deleted_indices)
-    result[indexes_sampled[deleted_indices]] = 0
-    deleted_sum = torch.sum(result)
-    
-    unshuf_order = torch.zeros_like(shuffle)
-    unshuf_order[shuffle] = torch.arange(n)
-    result[shuffle] = result.clone()
-    # print(b, m, "res", result)
+    result = torch.zeros(n, dtype=torch.int, device=device)
+    result[shuffle.to(device)] = (steps > 0).int()
+    if torch.sum(result) != m:
+        raise RuntimeError(f"systematic sampling selected {int(torch.sum(result))} entries instead of {m}")
+    return result.reshape(b_in.shape)
 
-    if (torch.sum(result) != m):
-        print(b.shape)
-        print("m", m)
-        print("num_to_delete", num_to_delete)
-        print("prob_sizes_len", len(prob_sizes))
-        print("s_sum", sampled_sum)
-        print("d_sum", deleted_sum)
-        raise RuntimeError()
-    # print(b, m, "res", result)
-    return result
-
-def mirror_descent_torch(Q, b, a, step_size = 0.01, T_mirror = 50):
+def mirror_descent_torch(Q, b, a, step_size = 0.01, T_mirror = 50, tol=None, Qb=None, return_state=False):
     # b is a vector whose sum is 1
-    assert isinstance(Q, torch.Tensor)
+    # Q may be a sparse tensor or a query operator supporting @ and .T
+    # tol: stop early once the objective changes by less than tol (relative) between iterations
+    # Qb: Q @ b if it is already known, e.g. kept from the previous call when warm starting
+    # return_state: also return Q @ b for the returned b, so the next call can be warm started
     assert isinstance(b, torch.Tensor)
     assert isinstance(a, torch.Tensor)
 
@@ -326,22 +292,91 @@ def mirror_descent_torch(Q, b, a, step_size = 0.01, T_mirror = 50):
 
         return updated_x
 
-    # Function to compute the gradient of the objective function ||Qb - a||_2^2
-    def gradient(Q, b, a):
-        return 2 * torch.matmul(Q.T, (torch.matmul(Q, b) - a))
-
+    objective = None
     iters = 0
 
     # Mirror Descent iterations
     while iters < T_mirror:
+        if Qb is None:
+            Qb = Q @ b
+        if tol is not None:
+            prev_objective, objective = objective, torch.sum((Qb - a) ** 2)
+            if prev_objective is not None and torch.abs(prev_objective - objective) <= tol * prev_objective:
+                break
         iters += 1
-        # Compute the gradient of the objective function
-        grad = gradient(Q, b, a)
+        # Compute the gradient of the objective function ||Qb - a||_2^2
+        grad = 2 * (Q.T @ (Qb - a))
         # Update using Mirror Descent
         b = mirror_descent_update(b, grad)
+        Qb = None
         # print("B update step: ", b)
+    if return_state:
+        return b, (Q @ b if Qb is None else Qb)
     return b
 
+def mirror_descent(Q, b, a, step_size = 0.01, T_mirror = 50):
+    """ NumPy counterpart of mirror_descent_torch: minimises ||Qb - a||_2^2 over the simplex, for a
+    scipy sparse (or dense) Q """
+    # b is a vector whose sum is 1
+    b = np.asarray(b, dtype=np.float64)
+    a = np.asarray(a, dtype=np.float64)
+    assert Q.shape == (len(a), len(b))
+    # the transpose is materialised once, so both products of every iteration run over CSR rows
+    QT = Q.T.tocsr() if scipy.sparse.issparse(Q) else Q.T
+    
+    for _ in range(T_mirror):
+        # gradient of ||Qb - a||_2^2, then the multiplicative update and renormalisation
+        grad = 2.0 * (QT @ (Q @ b - a))
+        b = b * np.exp(-step_size * grad)
+        b /= np.sum(b)
+    return b
+
+class CSRRowBuilder:
+    """
+    Rows of a linear system Q b = a, grown by appending blocks of rows of Q (with their entries of a).
+    The CSR arrays are preallocated and grow geometrically, so appending costs amortised O(nnz) of the
+    block, and matrix() is a view of the rows appended so far rather than a rebuilt matrix.
+    """
+    def __init__(self, n_cols, capacity_rows=1024, capacity_nnz=1 << 20):
+        self.n_cols = n_cols
+        self.n_rows = 0
+        self.nnz = 0
+        self.indptr = np.zeros(capacity_rows + 1, dtype=np.int64)
+        self.indices = np.empty(capacity_nnz, dtype=np.int64)
+        self.data = np.empty(capacity_nnz, dtype=np.float64)
+        self.targets = np.empty(capacity_rows, dtype=np.float64)
+    
+    @staticmethod
+    def _reserve(array, size):
+        if size <= len(array):
+            return array
+        grown = np.empty(max(size, 2 * len(array)), dtype=array.dtype)
+        grown[:len(array)] = array
+        return grown
+    
+    def append(self, rows, targets):
+        rows = scipy.sparse.csr_matrix(rows)
+        assert rows.shape == (len(targets), self.n_cols)
+        n_rows, nnz = rows.shape[0], rows.nnz
+        self.indptr = self._reserve(self.indptr, self.n_rows + n_rows + 1)
+        self.targets = self._reserve(self.targets, self.n_rows + n_rows)
+        self.indices = self._reserve(self.indices, self.nnz + nnz)
+        self.data = self._reserve(self.data, self.nnz + nnz)
+        
+        self.indptr[self.n_rows + 1:self.n_rows + n_rows + 1] = rows.indptr[1:] + self.nnz
+        self.targets[self.n_rows:self.n_rows + n_rows] = targets
+        self.indices[self.nnz:self.nnz + nnz] = rows.indices
+        self.data[self.nnz:self.nnz + nnz] = rows.data
+        self.n_rows += n_rows
+        self.nnz += nnz
+    
+    def matrix(self):
+        return scipy.sparse.csr_matrix((self.data[:self.nnz], self.indices[:self.nnz], self.indptr[:self.n_rows + 1]),
+                                       shape=(self.n_rows, self.n_cols), copy=False)
+    
+    def rhs(self):
+        return self.targets[:self.n_rows]
+
 def mosek_optimize(Q, a, m, N, ):
     # get everything into numpy to work with mosek
     Q = Q.to_dense().numpy(force=True).astype(np.float64)
@@ -366,6 +401,9 @@ def mosek_optimize(Q, a, m, N, ):
     return res
 
 
+def GM(inp, rho, n_relationship_orig):
+    return inp + np.random.normal(0, np.sqrt(2)/(n_relationship_orig * np.sqrt(rho)), size=np.shape(inp))
+
 def GM_torch(inp, rho, n_relationship_orig):
     rand = torch.normal(0.0, (np.sqrt(2)/(n_relationship_orig * np.sqrt(rho))).item(), inp.size())
     return inp + rand
@@ -385,7 +423,91 @@ def expround_torch(b, m=None, device="cpu"):
     bu = torch.sparse_coo_tensor(indices, torch.ones([m], device=device), b.size()).coalesce()
     return bu
 
+def expround(b, m=None):
+    """ NumPy counterpart of expround_torch: keeps the m cells with the largest exponential draws
+    X_i ~ Exp(scale=b_i), as a dense 0/1 vector """
+    N = len(b)
+    if m is None:
+        m = int(np.sum(b))
+    bu = np.zeros(N)
+    if m <= 0:
+        return bu
+    X = np.random.exponential(np.maximum(b, 0))
+    # argpartition selects the top m in linear time, instead of sorting all N cells
+    bu[np.argpartition(X, N - m)[N - m:]] = 1
+    return bu
+
+def exp_mech_topk(scores, k):
+    """Samples min(k, len(scores)) distinct indices without replacement, where each successive
+    pick is drawn from the remaining indices with probability proportional to exp(score).
+    Uses the Gumbel-top-k trick: this is a single perturb-and-sort instead of one softmax per pick."""
+    scores = np.asarray(scores, dtype=np.float64)
+    perturbed = scores + np.random.gumbel(size=scores.shape)
+    return np.argsort(-perturbed)[:k]
+
+class RelationshipSet:
+    """
+    The set of synthetic relationships, stored as sorted int64 cell keys table1_idx * n_syn2 + table2_idx.
+    Slices are replaced in place with binary searches, so an update costs O(slice + log n) lookups plus
+    one array copy, instead of re-sorting a sparse tensor of the whole cross product.
+    """
+    def __init__(self, keys, n_syn1, n_syn2):
+        self.n_syn1 = n_syn1
+        self.n_syn2 = n_syn2
+        self.keys = np.unique(np.asarray(keys, dtype=np.int64))
+        self._indices = None
+    
+    @classmethod
+    def from_sparse(cls, qm, b_round):
+        table1_nums, table2_nums = get_relationships_from_sparse(qm, b_round)
+        keys = np.atleast_1d(table1_nums).astype(np.int64) * qm.n_syn2 + np.atleast_1d(table2_nums)
+        return cls(keys, qm.n_syn1, qm.n_syn2)
+    
+    def __len__(self):
+        return len(self.keys)
+    
+    def _find(self, cells):
+        """ Positions of cells in self.keys, and a mask of which cells are present """
+        cells = np.asarray(cells, dtype=np.int64)
+        pos = np.searchsorted(self.keys, cells)
+        found = pos < len(self.keys)
+        found[found] = self.keys[pos[found]] == cells[found]
+        return pos, found
+    
+    def cells_in(self, cells):
+        """ The relationships that lie among the given cells """
+        cells = np.asarray(cells, dtype=np.int64)
+        return cells[self._find(cells)[1]]
+    
+    def count_in(self, cells):
+        return int(np.count_nonzero(self._find(cells)[1]))
+    
+    def remove(self, cells):
+        pos, found = self._find(cells)
+        self.keys = np.delete(self.keys, pos[found])
+        self._indices = None
+    
+    def insert(self, cells):
+        cells = np.unique(np.asarray(cells, dtype=np.int64))
+        cells = cells[~self._find(cells)[1]]
+        self.keys = np.insert(self.keys, np.searchsorted(self.keys, cells), cells)
+        self._indices = None
+    
+    def indices(self):
+        """ (table1_idx, table2_idx) arrays of the relationships, cached until the next update """
+        if self._indices is None:
+            self._indices = (self.keys // self.n_syn2, self.keys % self.n_syn2)
+        return self._indices
+    
+    def to_sparse(self, device="cpu"):
+        """ Exports the set as a 1-D sparse COO tensor over the n_syn1 * n_syn2 cross product """
+        keys = torch.from_numpy(self.keys)
+        return torch.sparse_coo_tensor(keys[None, :], torch.ones(len(keys)), size=[self.n_syn1 * self.n_syn2],
+                                       device=device).coalesce()
+
 def get_relationships_from_sparse(qm, b_round):
+    if isinstance(b_round, RelationshipSet):
+        return b_round.indices()
     b_round = b_round.coalesce()
     vals = b_round.values()
     indices = b_round.indices()
@@ -403,7 +525,7 @@ def largest_singular_value(sparse_tensor, tolerance=1e-6, max_iterations=1000):
     Calculate the largest singular value of a sparse tensor using power iteration.
     
     Parameters:
-    sparse_tensor (torch.sparse_coo_tensor): Input sparse tensor.
+    sparse_tensor (torch.sparse_coo_tensor or SparseQueryMatrix): Input sparse matrix, anything supporting @ and .T.
     tolerance (float): Desired error tolerance for convergence.
     max_iterations (int): Maximum number of iterations to perform.
     
@@ -411,7 +533,7 @@ def largest_singular_value(sparse_tensor, tolerance=1e-6, max_iterations=1000):
     float: Approximation of the largest singular value.
     """
     # Ensure the input is a sparse tensor
-    assert sparse_tensor.is_sparse, "Input tensor must be sparse"
+    assert not isinstance(sparse_tensor, torch.Tensor) or sparse_tensor.is_sparse, "Input tensor must be sparse"
 
     # Initialize a random vector
     N = sparse_tensor.size(1)
@@ -422,12 +544,12 @@ def largest_singular_value(sparse_tensor, tolerance=1e-6, max_iterations=1000):
     singular_value_old = 0.0
     for _ in range(max_iterations):
         # Perform the matrix multiplication
-        b_k1 = torch.sparse.mm(sparse_tensor, b_k.view(-1, 1)).view(-1)
+        b_k1 = (sparse_tensor @ b_k.view(-1, 1)).view(-1)
         b_k1_norm = torch.norm(b_k1)
         b_k1 = b_k1 / b_k1_norm
 
         # Perform the matrix multiplication with the transpose
-        b_k = torch.sparse.mm(sparse_tensor.t(), b_k1.view(-1, 1)).view(-1)
+        b_k = (sparse_tensor.T @ b_k1.view(-1, 1)).view(-1)
         b_k_norm = torch.norm(b_k)
         b_k = b_k / b_k_norm
 
@@ -438,10 +560,54 @@ def largest_singular_value(sparse_tensor, tolerance=1e-6, max_iterations=1000):
 
     return b_k_norm.item()
 
+def query_spectral_norm(Q, exact=False):
+    """
+    Largest singular value of a query matrix, used to set the PGD step size.
+    
+    Stacked workload query matrices (SparseQueryMatrix, KroneckerQueryOperator) have a closed-form
+    upper bound computed from the code counts of the slice, which is exact for a single workload.
+    For several workloads it overestimates the norm, by up to ~1.3x for 30 3-way workloads and more
+    as workloads are added, so the step size (which scales with 1 / norm^2) is up to ~1.7x smaller
+    than with the exact norm. This changes the default optimizer behaviour: exact=True (the
+    exact_step_size option of the PGD strategies) uses power iteration, as before, and so do
+    matrices without a bound.
+    """
+    if not exact and hasattr(Q, "spectral_norm_bound"):
+        return Q.spectral_norm_bound()
+    return largest_singular_value(Q)
+
+class SpectralNormCache:
+    """
+    Memoizes query_spectral_norm by (workload set, slice). The norm does not depend on the order of
+    the workloads or of the slice rows, so both are keyed as sorted sets.
+    
+    Only power iteration is memoized: the closed-form bound is cheaper than building the key, and
+    depends on the code counts of the slice rows, so a key on anything less than the slice is unsafe.
+    """
+    def __init__(self, exact=False, max_entries=256):
+        self.exact = exact
+        self.max_entries = max_entries
+        self.cache = OrderedDict()
+    
+    def get(self, Q, workloads, slice_t1, slice_t2):
+        if not self.exact and hasattr(Q, "spectral_norm_bound"):
+            return Q.spectral_norm_bound()
+        key = (tuple(sorted(workloads)),
+               np.sort(np.asarray(slice_t1)).tobytes(),
+               np.sort(np.asarray(slice_t2)).tobytes())
+        if key in self.cache:
+            self.cache.move_to_end(key)
+            return self.cache[key]
+        norm = query_spectral_norm(Q, exact=self.exact)
+        self.cache[key] = norm
+        if len(self.cache) > self.max_entries:
+            self.cache.popitem(last=False)
+        return norm
+
 def gradient(Q, b, a, m):
     """ Helper function to compute the gradient of the objective function."""
-    c = torch.sparse.mm(Q, b) / m ## 
-    g = torch.sparse.mm(Q.T, (-a)[:, None] + c) * 2 / m
+    c = (Q @ b) / m ## 
+    g = (Q.T @ ((-a)[:, None] + c)) * 2 / m
 
     return g
 
@@ -468,37 +634,47 @@ def projsplx_torch(b):
     #print("res", res.size())
     return res
 
+def projsplx_rows_torch(B):
+    """ Projects every row of the matrix B onto the probability simplex at once.
+    Row-wise equivalent of projsplx_torch, using a single sort and cumsum. """
+    N = B.size(dim=1)
+    sorted_B, _ = torch.sort(B, dim=1)
+    cumsum_sorted_B = torch.cumsum(sorted_B, dim=1)
+    totals = cumsum_sorted_B[:, -1:]
+    t_hat = (totals - 1) / N
+    if N == 1:
+        return torch.clip(B - t_hat, min=0, max=1)
+    
+    fracs = ((totals - cumsum_sorted_B[:, :-1]) - 1) / (N - (torch.arange(1, N, device=B.device)))
+    satisfied = fracs >= sorted_B[:, :-1]
+    # last satisfying position of each row, -1 where there is none
+    last_idx = (satisfied * torch.arange(1, N, device=B.device)).amax(dim=1, keepdim=True) - 1
+    t_hat = torch.where(last_idx >= 0, torch.gather(fracs, 1, last_idx.clamp(min=0)), t_hat)
+    return torch.clip(B - t_hat, min=0, max=1)
+
 def one_to_many_project(b, row_size):
-    b_cp = b.clone()
-    for x in range(0, len(b), row_size):
-        b_cp[x:x+row_size] = projsplx_torch(torch.flatten(b[x:x+row_size]))[:, None]
-    return b_cp
+    if len(b) % row_size != 0:
+        raise ValueError(f"vector of length {len(b)} cannot be split into rows of size {row_size}")
+    return projsplx_rows_torch(b.reshape(-1, row_size)).reshape(b.shape)
 
 def one_to_many_sample(b, row_size):
-    b_cp = b.clone()
-    for x in range(0, len(b), row_size):
-        dist = OneHotCategorical(b[x:x+row_size])
-        b_cp[x:x+row_size] = dist.sample()
-    return b_cp
-
-def pgd_optimize_one_to_many(Q, b, a, m, T, row_size):
-    # 1. Calculate the learning rate
-    l = largest_singular_value(Q)
-    L = (l * l) * 2 / (m*m)
-    lr = 1/L
-    
-    # 2. Perform the PGD
-    for t in range(T):
-        print(t)
-        # 2a. Identify the gradient of the solution
-        g = gradient(Q, b, a, m)
-        # 2b. Iterate the b value and correctly project it
-        # TODO: this may be able to avoid sparsity issues!!!
-        b = -(lr * g) + b 
-        b = one_to_many_project(b, row_size)
-        # b = b[:, None]
-    
-    return b
+    """ Draws one entry from every row of size row_size, with probabilities proportional to b.
+    All rows are sampled at once by an inverse-CDF search on the row cumsums; the result is
+    returned as a sparse one-hot vector of the same length as b. """
+    if len(b) % row_size != 0:
+        raise ValueError(f"vector of length {len(b)} cannot be split into rows of size {row_size}")
+    B = torch.clamp(b.reshape(-1, row_size), min=0)
+    B_cumsum = torch.cumsum(B, dim=1)
+    u = torch.rand((B.size(dim=0), 1), device=b.device, dtype=B_cumsum.dtype) * B_cumsum[:, -1:]
+    chosen = torch.searchsorted(B_cumsum, u, right=True).clamp(max=row_size - 1)
+    indices = torch.squeeze(chosen, dim=1) + torch.arange(0, len(b), row_size, device=b.device)
+    return torch.sparse_coo_tensor(indices[None, :], torch.ones_like(indices, dtype=b.dtype),
+                                   size=[len(b)], device=b.device).coalesce()
+
+def pgd_optimize_one_to_many(Q, b, a, m, T, row_size, spectral_norm=None, tol=None, grad_tol=None, return_trace=False):
+    """ pgd_optimize, with the projection enforcing one relationship per row of row_size cells """
+    return _pgd_optimize(Q, b, a, m, T, lambda b: one_to_many_project(b, row_size), spectral_norm=spectral_norm,
+                         tol=tol, grad_tol=grad_tol, return_trace=return_trace)
 
 def optimal_project_to_simplex_torch(b, m):
     # return projection_binarysearch_torch(b, m)
@@ -514,11 +690,12 @@ def optimal_project_to_simplex_torch(b, m):
     sorted_b, sorted_indices = torch.sort(b, descending=True)
     
     # Step 4: Find the first index i that satisfies the conditions
+    # (evaluated for every i at once; falls through to the last index if none does)
     cumsum_sorted_b = torch.cumsum(sorted_b, dim=0)
     N = len(b)
-    for i in range(N):
-        if sorted_b[i] > 0 and (m - (i + 1)) / (cumsum_sorted_b[-1] - cumsum_sorted_b[i]) <= 1:
-            break
+    num_ones = torch.arange(1, N + 1, device=b.device, dtype=b.dtype)
+    satisfied = (sorted_b > 0) & ((m - num_ones) / (cumsum_sorted_b[-1] - cumsum_sorted_b) <= 1)
+    i = int(torch.argmax(satisfied.to(torch.uint8))) if bool(satisfied.any()) else N - 1
     
     # Step 5: Set v_1, ..., v_i to 1
     sorted_b[:i + 1] = 1
@@ -579,20 +756,54 @@ def optimal_project_to_simplex_torch(b, m):
 #     x = b + d
 #     return x, torch.sum(x), torch.norm(d)
 
-def pgd_optimize(Q, b, a, m, T):
+def pgd_optimize(Q, b, a, m, T, spectral_norm=None, tol=None, grad_tol=None, return_trace=False):
+    """
+    Projected gradient descent on ||Qb/m - a||_2^2 over {0 <= b <= 1, sum(b) = m}, for at most T steps.
+    tol: stop once the objective changes by less than tol, relative to its previous value
+    grad_tol: stop once the norm of the projected gradient step, ||b_next - b|| / lr, is below grad_tol
+    return_trace: also return a dict with the step size lr and, per step, the objective before the
+    step, the norm ||b_next - b|| of the step and the time since the start
+    """
+    return _pgd_optimize(Q, b, a, m, T, lambda b: optimal_project_to_simplex_torch(b, m)[:, None],
+                         spectral_norm=spectral_norm, tol=tol, grad_tol=grad_tol, return_trace=return_trace)
+
+def _pgd_optimize(Q, b, a, m, T, project, spectral_norm=None, tol=None, grad_tol=None, return_trace=False):
     # 1. Calculate the learning rate
-    l = largest_singular_value(Q)
+    l = query_spectral_norm(Q) if spectral_norm is None else spectral_norm
     L = (l * l) * 2 / (m*m)
     lr = 1/L
     
+    trace = {"lr": lr, "objective": [], "step_size": [], "time": []}
+    # the objective and step norms are only computed (and synchronised to the host) when needed
+    track = return_trace or tol is not None or grad_tol is not None
+    prev_objective = None
+    time_start = time.perf_counter()
+    
     # 2. Perform the PGD
     for t in range(T):
-        # 2a. Identify the gradient of the solution
-        g = gradient(Q, b, a, m)
+        # 2a. Identify the gradient of the solution (see gradient)
+        residual = (Q @ b) / m - a[:, None]
+        g = (Q.T @ residual) * 2 / m
         # 2b. Iterate the b value and correctly project it
         # TODO: this may be able to avoid sparsity issues!!!
-        b = -(lr * g) + b 
-        b = optimal_project_to_simplex_torch(b, m)
-        b = b[:, None]
+        b_next = project(-(lr * g) + b)
+        
+        if track:
+            objective = float(torch.sum(residual * residual))
+            step_size = float(torch.linalg.vector_norm(b_next - b))
+            trace["objective"].append(objective)
+            trace["step_size"].append(step_size)
+            trace["time"].append(time.perf_counter() - time_start)
+        b = b_next
+        
+        # 2c. Stop early once converged
+        if tol is not None and prev_objective is not None and abs(prev_objective - objective) <= tol * prev_objective:
+            break
+        if grad_tol is not None and step_size / lr <= grad_tol:
+            break
+        if track:
+            prev_objective = objective
     
-    return b
\ No newline at end of file
+    if return_trace:
+        return b, trace
+    return b
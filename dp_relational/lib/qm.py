@@ -1,11 +1,81 @@
-from .dataset import RelationalDataset
+from .dataset import RelationalDataset, make_code_matrix, make_edge_array
+import copy
 import itertools
+import os
+import pickle
+from collections import OrderedDict
+from functools import partial
 import numpy as np
+import scipy.sparse
 
 import torch
 
 from tqdm import tqdm
 
+class OffsetIndex:
+    """
+    Offset index for one table: row i holds the (zero-indexed) query offset of every table row
+    for workload i, stored as int32.
+    
+    If the whole (num_workloads x n_rows) matrix fits in max_bytes it is built once up front;
+    otherwise rows are computed on demand and kept in an LRU cache of at most max_bytes.
+    """
+    def __init__(self, compute_row, num_workloads, n_rows, max_bytes):
+        self.compute_row = compute_row
+        self.num_workloads = num_workloads
+        self.n_rows = n_rows
+        
+        row_bytes = max(n_rows, 1) * np.dtype(np.int32).itemsize
+        self.matrix = None
+        self.lru = OrderedDict()
+        self.max_cached_rows = max(1, max_bytes // row_bytes)
+        if num_workloads <= self.max_cached_rows:
+            self.matrix = np.empty((num_workloads, n_rows), dtype=np.int32)
+            for i in range(num_workloads):
+                self.matrix[i] = compute_row(i)
+            self.matrix.flags.writeable = False
+    
+    @classmethod
+    def from_matrix(cls, matrix):
+        """ An index over a precomputed (num_workloads x n_rows) offset matrix, e.g. a memory map """
+        index = cls.__new__(cls)
+        index.compute_row = None
+        index.num_workloads, index.n_rows = matrix.shape
+        index.matrix = matrix
+        index.lru = OrderedDict()
+        index.max_cached_rows = 0
+        return index
+    
+    def __getitem__(self, workload_idx):
+        if self.matrix is not None:
+            return self.matrix[workload_idx]
+        row = self.lru.get(workload_idx)
+        if row is None:
+            row = self.compute_row(workload_idx).astype(np.int32)
+            row.flags.writeable = False
+            self.lru[workload_idx] = row
+            if len(self.lru) > self.max_cached_rows:
+                self.lru.popitem(last=False)
+        else:
+            self.lru.move_to_end(workload_idx)
+        return row
+    
+    def gather(self, workload_idxes):
+        """Returns the offsets of several workloads (a list of indices or a slice) as a
+        (num_workloads x n_rows) matrix. Slices of a fully built index are returned as views."""
+        if self.matrix is not None:
+            return self.matrix[workload_idxes]
+        if isinstance(workload_idxes, slice):
+            workload_idxes = range(*workload_idxes.indices(self.num_workloads))
+        return np.stack([self[i] for i in workload_idxes]) if len(workload_idxes) > 0 \
+            else np.empty((0, self.n_rows), dtype=np.int32)
+
+def load_query_manager(path, rel_dataset, df1_synth, df2_synth, mmap_mode="r"):
+    """ Loads a query manager saved with QueryManager.save_state, whatever its class """
+    with open(os.path.join(path, QueryManager.STATE_FILE), "rb") as file_in:
+        qm_class = pickle.load(file_in)["__class__"]
+    return qm_class.load_state(path, rel_dataset, df1_synth, df2_synth, mmap_mode=mmap_mode)
+
 class QueryManager:
     """
     Query manager class.
@@ -13,9 +83,19 @@ class QueryManager:
     and two pregenerated synthetic tables, returns an interface that allows for the
     calculation of "true" answers from the synthetic dataset.
     
-    Also stores query vectors
+    Also stores query vectors. Per-workload offsets of every table are kept in an OffsetIndex,
+    using at most offset_cache_bytes per table.
+    
+    The precomputed state (workload table, offsets and true answers) can be written to a directory
+    with save_state and memory-mapped back with load_state, skipping the precomputation.
     """
-    def __init__(self, rel_dataset: RelationalDataset, k, df1_synth, df2_synth, otm=False, verbose=False) -> None:
+    STATE_FILE = "state.pkl"
+    # attributes that are not part of the pickled state: inputs passed back to load_state, and
+    # arrays stored as .npy files (or derived from them)
+    STATE_EXCLUDED = ("rel_dataset", "df1_synth", "df2_synth", "table_codes", "offset_index",
+                      "true_ans_vec", "true_ans", "rand_ans")
+    def __init__(self, rel_dataset: RelationalDataset, k, df1_synth, df2_synth, otm=False, verbose=False,
+                 offset_cache_bytes=2**30) -> None:
         self.verbose = verbose
         
         self.rel_dataset = rel_dataset
@@ -28,6 +108,8 @@ class QueryManager:
         self.n_syn_cross = self.n_syn1 * self.n_syn2
         
         self.otm = otm
+        
+        self.table_codes = self.make_table_codes(rel_dataset, df1_synth, df2_synth)
         # print("t1", self.rel_dataset.table1.df.shape[0])
         # print("t2", self.rel_dataset.table2.df.shape[0])
         # print("rel", self.rel_dataset.df_rel.shape[0])
@@ -104,6 +186,18 @@ class QueryManager:
         
         last_workload = self.workload_names[-1]
         self.num_all_queries = self.workload_dict[last_workload]["range_high"] + 1
+        self.workload_index = {w: i for i, w in enumerate(self.workload_names)}
+        # start of each workload in the flat answer vector
+        self.range_lows = np.array([self.workload_dict[w]["range_low"] for w in self.workload_names], dtype=np.int64)
+        
+        # offsets are stored as int32
+        assert max(w["range_size"] for w in self.workload_dict.values()) < 2**31
+        self.offset_index = [
+            [OffsetIndex(partial(self.compute_offsets, table_num=table_num, is_synth=bool(is_synth)),
+                         len(self.workload_names), self.table_codes[is_synth][table_num][0].shape[1], offset_cache_bytes)
+             for table_num in range(2)]
+            for is_synth in range(2)
+        ]
         
         def calculate_rand_ans():
             rand_ans = np.zeros(self.num_all_queries) # what answers would a random system give?
@@ -111,55 +205,107 @@ class QueryManager:
                 w = self.workload_dict[workload_name]
                 rand_ans[w['range_low']: (w['range_high']+1)] = 1.0/(w['range_high'] - w['range_low'] + 1)
             return rand_ans
-        def calculate_true_ans():
-            df_rel = rel_dataset.df_rel
-            num_relationship = df_rel.shape[0]
-            
-            ID1s = df_rel.iloc[:][rel_dataset.rel_id1_col].values
-            ID2s = df_rel.iloc[:][rel_dataset.rel_id2_col].values
-            
-            true_ans = np.zeros(self.num_all_queries) 
-            for w in self.workload_names:
-                w_dict = self.workload_dict[w]
-                
-                offsets_t1 = self.get_offsets(w, 0, is_synth=False)
-                offsets_t2 = self.get_offsets(w, 1, is_synth=False)
-                
-                offsets = offsets_t1[ID1s] + offsets_t2[ID2s]
-                values, counts = np.unique(offsets, return_counts=True)
-                for val, count in zip(values, counts):
-                    true_ans[w_dict["range_low"] + val] = count
-            
-            true_ans = true_ans/num_relationship
-            
-            return true_ans
-        
         self.rand_ans = calculate_rand_ans()
-        self.true_ans = self.calculate_true_ans()
+        self.true_ans_vec = self.calculate_ans_vector(self.rel_dataset.edges, is_synth=False)
+        self.true_ans = self.split_workloads(self.true_ans_vec)
+        
+    @staticmethod
+    def make_table_codes(rel_dataset, df1_synth, df2_synth):
+        """ Compact array representation of the real and synthetic tables, indexed by [is_synth][table_num] """
+        if getattr(rel_dataset, 'edges', None) is None:
+            rel_dataset.make_arrays() # datasets saved before the array representation existed
+        return [
+            [(rel_dataset.table1.codes, rel_dataset.table1.column_index),
+             (rel_dataset.table2.codes, rel_dataset.table2.column_index)],
+            [make_code_matrix(df1_synth), make_code_matrix(df2_synth)]
+        ]
+    
+    def save_state(self, path):
+        """ Writes the precomputed state to the directory path. Offsets and answers are stored as .npy
+        files so that load_state can memory-map them. """
+        os.makedirs(path, exist_ok=True)
+        for is_synth in range(2):
+            for table_num in range(2):
+                index = self.offset_index[is_synth][table_num]
+                offsets = np.lib.format.open_memmap(os.path.join(path, f"offsets_{is_synth}_{table_num}.npy"), mode="w+",
+                                                    dtype=np.int32, shape=(index.num_workloads, index.n_rows))
+                # written row by row, so indexes that do not fit in memory are never fully materialized
+                for workload_idx in range(index.num_workloads):
+                    offsets[workload_idx] = index[workload_idx]
+                offsets.flush()
+                del offsets
+        np.save(os.path.join(path, "true_ans.npy"), self.true_ans_vec)
+        np.save(os.path.join(path, "rand_ans.npy"), self.rand_ans)
+        state = {key: value for key, value in self.__dict__.items() if key not in self.STATE_EXCLUDED}
+        state["__class__"] = type(self)
+        with open(os.path.join(path, self.STATE_FILE), "wb") as file_out:
+            pickle.dump(state, file_out)
+    
+    @classmethod
+    def load_state(cls, path, rel_dataset, df1_synth, df2_synth, mmap_mode="r"):
+        """ Restores a query manager saved by save_state, for the same dataset and synthetic tables """
+        with open(os.path.join(path, cls.STATE_FILE), "rb") as file_in:
+            state = pickle.load(file_in)
+        del state["__class__"]
+        qm = cls.__new__(cls)
+        qm.__dict__.update(state)
+        
+        qm.rel_dataset = rel_dataset
+        qm.df1_synth = df1_synth
+        qm.df2_synth = df2_synth
+        qm.table_codes = cls.make_table_codes(rel_dataset, df1_synth, df2_synth)
+        qm.offset_index = [
+            [OffsetIndex.from_matrix(np.load(os.path.join(path, f"offsets_{is_synth}_{table_num}.npy"), mmap_mode=mmap_mode))
+             for table_num in range(2)]
+            for is_synth in range(2)
+        ]
+        qm.true_ans_vec = np.load(os.path.join(path, "true_ans.npy"), mmap_mode=mmap_mode)
+        qm.true_ans = qm.split_workloads(qm.true_ans_vec)
+        qm.rand_ans = np.load(os.path.join(path, "rand_ans.npy"), mmap_mode=mmap_mode)
+        return qm
+    
+    def calculate_ans_vector(self, df_rel, is_synth, max_chunk_bytes=2**28):
+        """Answers every workload on a relationship table, given either as a DataFrame with the
+        dataset's id columns or as an (n_relationships, 2) edge array.
+        
+        Returns the flat answer vector of length num_all_queries. The answers of all workloads
+        are counted with a single bincount over the offsets shifted by each workload's range_low;
+        if that would need more than max_chunk_bytes, workloads are counted in chunks instead."""
+        if isinstance(df_rel, np.ndarray):
+            edges = df_rel
+        else:
+            edges = make_edge_array(df_rel, self.rel_dataset.rel_id1_col, self.rel_dataset.rel_id2_col)
+        num_relationship = edges.shape[0]
         
+        counts = self.count_answers(edges[:, 0], edges[:, 1], is_synth, max_chunk_bytes=max_chunk_bytes)
+        # an empty relationship set has all-zero counts, and answers of zero
+        return counts / max(num_relationship, 1)
+    
+    def count_answers(self, ID1s, ID2s, is_synth, max_chunk_bytes=2**28):
+        """Counts, for every query of every workload, how many of the relationships (ID1s[i], ID2s[i])
+        fall in it. Returns an int64 vector of length num_all_queries (see calculate_ans_vector)."""
+        num_relationship = len(ID1s)
+        num_workloads = len(self.workload_names)
+        chunk_size = max(1, max_chunk_bytes // (8 * max(num_relationship, 1)))
+        counts = np.zeros(self.num_all_queries, dtype=np.int64)
+        for start in range(0, num_workloads, chunk_size):
+            chunk = slice(start, min(start + chunk_size, num_workloads))
+            offsets = np.take(self.get_workload_offsets(chunk, 0, is_synth=is_synth), ID1s, axis=1).astype(np.int64)
+            offsets += np.take(self.get_workload_offsets(chunk, 1, is_synth=is_synth), ID2s, axis=1)
+            offsets += self.range_lows[chunk, None]
+            counts += np.bincount(offsets.ravel(), minlength=self.num_all_queries)
+        return counts
+    
+    def split_workloads(self, ans_vec):
+        """Splits a flat answer vector into a list of per-workload views (no copies)"""
+        return np.split(ans_vec, self.range_lows[1:])
+    
     def calculate_ans_from_rel_dataset(self, df_rel, is_synth):
-        num_relationship = df_rel.shape[0]
-        
-        ID1s = df_rel.iloc[:][self.rel_dataset.rel_id1_col].values
-        ID2s = df_rel.iloc[:][self.rel_dataset.rel_id2_col].values
-        
-        ans = [] # np.zeros(self.num_all_queries) 
-        for w in self.workload_names:
-            # print(":", w)
-            w_dict = self.workload_dict[w]
-            
-            offsets_t1 = self.get_offsets(w, 0, is_synth=is_synth)
-            offsets_t2 = self.get_offsets(w, 1, is_synth=is_synth)
-            
-            offsets = offsets_t1[ID1s] + offsets_t2[ID2s]
-            values, counts = np.unique(offsets, return_counts=True)
-            ans.append(np.zeros((w_dict["range_size"], )))
-            for val, count in zip(values, counts):
-                ans[-1][val] = count / num_relationship
-        return ans
+        """Per-workload answers on a relationship table, as views into calculate_ans_vector"""
+        return self.split_workloads(self.calculate_ans_vector(df_rel, is_synth))
     
     def calculate_true_ans(self):
-        return self.calculate_ans_from_rel_dataset(self.rel_dataset.df_rel, is_synth=False)
+        return self.split_workloads(self.calculate_ans_vector(self.rel_dataset.edges, is_synth=False))
     
     def query_ind(self, workload, val, zero_index=False):
         assert len(workload) == 2 #since only two tables
@@ -196,65 +342,91 @@ class QueryManager:
         return q_ind
 
     def get_offsets(self, workload, table_num, is_synth=True):
+        """Returns the query offset of every row of a table for a workload (read-only, from the offset index)"""
         assert table_num == 0 or table_num == 1
-        
-        dfs = [self.df1_synth, self.df2_synth] if is_synth else [self.rel_dataset.table1.df,self.rel_dataset.table2.df]
-        df = dfs[table_num]
-
-        # print(workload[table_num])
-        # print(self.df1_synth.columns, )
-        table = df[list(workload[table_num])]
-        table = tuple(table[x].iloc[:].values for x in workload[table_num])
+        return self.offset_index[int(is_synth)][table_num][self.workload_index[workload]]
+    
+    def get_workload_offsets(self, workload_idxes, table_num, is_synth=True):
+        """Returns the offsets of several workloads (given by index) as a (num_workloads x n_rows) matrix"""
+        assert table_num == 0 or table_num == 1
+        return self.offset_index[int(is_synth)][table_num].gather(workload_idxes)
+    
+    def compute_offsets(self, workload_idx, table_num, is_synth=True):
+        workload = self.workload_names[workload_idx]
+        codes, column_index = self.table_codes[int(is_synth)][table_num]
         
         dimsizes = self.workload_dict[workload][["dim_sizes_1", "dim_sizes_2"][table_num]]
-        data_sizes = [self.n_syn1, self.n_syn2] if is_synth \
-            else [self.rel_dataset.table1.df.shape[0],self.rel_dataset.table2.df.shape[0]]
-        data_size = data_sizes[table_num]
+        data_size = codes.shape[1]
 
         offsets = np.zeros(shape=data_size, dtype=np.int_)
-        for col in range(len(dimsizes)):
-            offsets += table[col] * dimsizes[col]
+        for col, dimsize in zip(workload[table_num], dimsizes):
+            # columns are stored as narrow unsigned codes, widen before scaling
+            offsets += codes[column_index[col]].astype(np.int_) * dimsize
 
         return offsets
 
+class SyntheticAnswerCache:
+    """
+    Answers of every workload on the current synthetic relationship set.
+    
+    The query counts are kept for all workloads at once and updated incrementally with the
+    relationships removed from and added to the set, so reading the answers after an update
+    costs O(changed relationships x workloads) rather than a pass over all relationships.
+    """
+    def __init__(self, qm: QueryManager, table1_idxes, table2_idxes) -> None:
+        self.qm = qm
+        self.counts = qm.count_answers(table1_idxes, table2_idxes, is_synth=True)
+        self.num_relationships = len(table1_idxes)
+    
+    def add(self, table1_idxes, table2_idxes):
+        self.counts += self.qm.count_answers(table1_idxes, table2_idxes, is_synth=True)
+        self.num_relationships += len(table1_idxes)
+    
+    def remove(self, table1_idxes, table2_idxes):
+        self.counts -= self.qm.count_answers(table1_idxes, table2_idxes, is_synth=True)
+        self.num_relationships -= len(table1_idxes)
+    
+    def get_ans_vector(self):
+        """Normalized answers of all workloads as a flat vector"""
+        # an empty relationship set has all-zero counts, and answers of zero
+        return self.counts / max(self.num_relationships, 1)
+    
+    def workload_errors(self, target_vec, workload_idxes):
+        """L1 distance between the cached answers and a flat answer vector (e.g. true_ans_vec),
+        for each of the workloads in workload_idxes"""
+        abs_errors = np.abs(self.get_ans_vector() - target_vec)
+        return np.add.reduceat(abs_errors, self.qm.range_lows)[workload_idxes]
+    
+    def get_answers(self, workload_idx):
+        """Normalized answers of a single workload"""
+        w_dict = self.qm.workload_dict[self.qm.workload_names[workload_idx]]
+        return self.counts[w_dict["range_low"]:(w_dict["range_high"] + 1)] / max(self.num_relationships, 1)
+
 class QueryManagerBasic(QueryManager):
-    def __init__(self, rel_dataset: RelationalDataset, k, df1_synth, df2_synth, verbose=False) -> None:
-        super().__init__(rel_dataset, k, df1_synth, df2_synth, verbose)
+    def __init__(self, rel_dataset: RelationalDataset, k, df1_synth, df2_synth, verbose=False, offset_cache_bytes=2**30) -> None:
+        super().__init__(rel_dataset, k, df1_synth, df2_synth, verbose=verbose, offset_cache_bytes=offset_cache_bytes)
         
         if verbose:
             print("Constructing query matrix")
-        # create the query matrix
-        Q1 = np.zeros((self.num_all_queries, self.n_syn1 * self.n_syn2))
-
-        for i in tqdm(range(self.n_syn1), disable=not verbose):
-            row = self.df1_synth.iloc[i]
-            #data indices
-            ind_d = [i*self.n_syn2 + j for j in range(self.n_syn2)]
-            
-            for w in self.workload_names:
-                val = list(row[list(w[0])])
-                #query indices
-                ind_q = self.query_ind_df1(w, val)
-                
-                Q1[np.ix_(ind_q, ind_d)] = 1
-                
-        Q2 = np.zeros((self.num_all_queries, self.n_syn1 * self.n_syn2))
-
-        for j in tqdm(range(self.n_syn2)):
-            row = self.df2_synth.iloc[j]
-            #data indices
-            ind_d = [i*self.n_syn2 + j for i in range(self.n_syn1)]
-            
-            for w in self.workload_names:
-                val = list(row[list(w[1])])
-                #query indices
-                ind_q = self.query_ind_df2(w, val)
-                
-                Q2[np.ix_(ind_q, ind_d)] = 1
-        
-        Q = Q1 * Q2
-        assert sum(sum(Q)) == (len(self.workload_names) * self.n_syn1 * self.n_syn2)
-        self.Q = Q
+        # create the query matrix: column i * n_syn2 + j of Q has exactly one nonzero per workload, at
+        # the query matching rows i and j. It is assembled in CSC form, where every column holds one
+        # row index per workload (already sorted, as workload ranges are increasing), then converted.
+        assert self.num_all_queries < 2**31
+        num_workloads = len(self.workload_names)
+        workload_idxes = np.arange(num_workloads)
+        offsets_t1 = self.get_workload_offsets(workload_idxes, 0)
+        offsets_t2 = self.get_workload_offsets(workload_idxes, 1)
+        
+        query_rows = np.empty((self.n_syn_cross, num_workloads), dtype=np.int32)
+        for w in tqdm(range(num_workloads), disable=not verbose):
+            query_rows[:, w] = (self.range_lows[w] + offsets_t1[w][:, None] + offsets_t2[w][None, :]).ravel()
+        
+        indptr = np.arange(self.n_syn_cross + 1, dtype=np.int64) * num_workloads
+        Q = scipy.sparse.csc_matrix((np.ones(query_rows.size), query_rows.ravel(), indptr),
+                                    shape=(self.num_all_queries, self.n_syn_cross))
+        del query_rows
+        self.Q = Q.tocsr()
+        assert self.Q.nnz == num_workloads * self.n_syn_cross
     def query_ind_workload(self, workload):
         return list(range(self.workload_dict[workload]['range_low'],
                           self.workload_dict[workload]['range_high'] + 1))
@@ -338,21 +510,248 @@ class QueryManagerBasic(QueryManager):
         assert max(q) <= self.workload_dict[workload]['range_high']
         return q
 
+def workload_spectral_norm_bound(counts_t1, counts_t2):
+    """
+    Upper bound on the largest singular value of a stacked slice query matrix, given for each
+    workload the number of slice rows of table 1 and table 2 that carry each code.
+    
+    Each Q_w has one nonzero per column, so Q_w Q_w^T is diagonal with the number of cells per
+    query, and ||Q_w||^2 = max(counts_t1) * max(counts_t2). Since Q^T Q = sum_w Q_w^T Q_w,
+    ||Q||^2 <= sum_w ||Q_w||^2, with equality for a single workload.
+    """
+    return float(np.sqrt(sum(int(c1.max()) * int(c2.max()) for c1, c2 in zip(counts_t1, counts_t2))))
+
+class SparseQueryMatrix:
+    """
+    Sparse query matrix Q stored in CSR form twice, as Q and as Q^T, so that both products used
+    by the optimizers (Q @ b and Q.T @ r) run as row-parallel CSR kernels.
+    Supports the small part of the tensor interface that the optimizers use: @, .T, size() and device.
+    """
+    def __init__(self, Q_csr, QT_csr, norm_bound=None) -> None:
+        self.Q_csr = Q_csr
+        self.QT_csr = QT_csr
+        self.norm_bound = norm_bound
+    
+    @property
+    def T(self):
+        return SparseQueryMatrix(self.QT_csr, self.Q_csr, norm_bound=self.norm_bound)
+    
+    def spectral_norm_bound(self):
+        """Upper bound on the largest singular value, see workload_spectral_norm_bound"""
+        return self.norm_bound
+    
+    @property
+    def shape(self):
+        return self.Q_csr.shape
+    
+    @property
+    def device(self):
+        return self.Q_csr.device
+    
+    def size(self, dim=None):
+        return self.Q_csr.size() if dim is None else self.Q_csr.size(dim)
+    
+    def __matmul__(self, x):
+        return self.Q_csr @ x
+
+class KroneckerQueryOperator:
+    """
+    Matrix-free stand-in for the stacked query matrix of several workloads on a slice.
+    
+    For a workload with t1_dim x t2_dim queries, the query of cell (i, j) is
+    codes_t1[i] * t2_dim + codes_t2[j]: Q_w is the face-splitting product of two one-hot
+    indicator matrices. Viewing b as a (|slice1|, |slice2|) matrix B, Q_w @ b is therefore
+    E1^T B E2 (two scatter-adds) and Q_w^T @ r is R[codes_t1][:, codes_t2] (two gathers),
+    so Q is never materialized. Memory is O(|slice1| * t2_dim) instead of
+    O(num_workloads * |slice1| * |slice2|).
+    
+    Supports the same interface as SparseQueryMatrix: @, .T, size() and device.
+    """
+    def __init__(self, codes_t1, codes_t2, dims, size_t1, size_t2, device="cpu", transposed=False) -> None:
+        self.codes_t1 = codes_t1 # one tensor of |slice1| codes per workload
+        self.codes_t2 = codes_t2
+        self.dims = dims # (t1_dim, t2_dim) per workload
+        self.size_t1 = size_t1
+        self.size_t2 = size_t2
+        self._device = device
+        self.transposed = transposed
+        self.row_starts = np.concatenate(([0], np.cumsum([d1 * d2 for d1, d2 in dims]))).astype(np.int64)
+    
+    @property
+    def T(self):
+        return KroneckerQueryOperator(self.codes_t1, self.codes_t2, self.dims, self.size_t1, self.size_t2,
+                                      device=self._device, transposed=not self.transposed)
+    
+    @property
+    def shape(self):
+        num_queries = int(self.row_starts[-1])
+        vec_len = self.size_t1 * self.size_t2
+        return torch.Size((vec_len, num_queries) if self.transposed else (num_queries, vec_len))
+    
+    @property
+    def device(self):
+        return self._device
+    
+    def size(self, dim=None):
+        return self.shape if dim is None else self.shape[dim]
+    
+    def spectral_norm_bound(self):
+        """Upper bound on the largest singular value, see workload_spectral_norm_bound"""
+        return workload_spectral_norm_bound([torch.bincount(c) for c in self.codes_t1],
+                                            [torch.bincount(c) for c in self.codes_t2])
+    
+    def __matmul__(self, x):
+        is_vector = x.dim() == 1
+        x = x.reshape(x.size(0), -1)
+        res = self._rmatmul(x) if self.transposed else self._matmul(x)
+        return res.view(-1) if is_vector else res
+    
+    def _matmul(self, b):
+        """Q @ b, for b of shape (|slice1| * |slice2|, k)"""
+        k = b.size(1)
+        b = b.view(self.size_t1, self.size_t2, k)
+        res = torch.empty((int(self.row_starts[-1]), k), dtype=b.dtype, device=b.device)
+        for w_num, (t1_dim, t2_dim) in enumerate(self.dims):
+            marg_t2 = torch.zeros((self.size_t1, t2_dim, k), dtype=b.dtype, device=b.device)
+            marg_t2.index_add_(1, self.codes_t2[w_num], b)
+            marg = torch.zeros((t1_dim, t2_dim, k), dtype=b.dtype, device=b.device)
+            marg.index_add_(0, self.codes_t1[w_num], marg_t2)
+            res[self.row_starts[w_num]:self.row_starts[w_num + 1]] = marg.view(-1, k)
+        return res
+    
+    def _rmatmul(self, r):
+        """Q^T @ r, for r of shape (num_queries, k)"""
+        k = r.size(1)
+        res = torch.zeros((self.size_t1, self.size_t2, k), dtype=r.dtype, device=r.device)
+        for w_num, (t1_dim, t2_dim) in enumerate(self.dims):
+            r_w = r[self.row_starts[w_num]:self.row_starts[w_num + 1]].view(t1_dim, t2_dim, k)
+            res += r_w.index_select(0, self.codes_t1[w_num]).index_select(1, self.codes_t2[w_num])
+        return res.view(-1, k)
+
+class StackedQueryMatrix:
+    """
+    Query matrix of a growing set of full-table workloads, appended one workload at a time.
+    
+    Q is kept as CSR arrays with spare capacity, so appending a workload writes only its own rows.
+    Every cell has exactly one query per workload, so Q^T is stored as a (n_cells, num_workloads)
+    matrix of query indices, and Q^T @ r is a gather of r followed by a row sum.
+    
+    Supports the same interface as SparseQueryMatrix: @, .T, size() and device.
+    """
+    def __init__(self, n_cells, device="cpu", capacity_workloads=8) -> None:
+        self.n_cells = n_cells
+        self._device = device
+        self.n_rows = 0
+        self.nnz = 0
+        self.num_workloads = 0
+        self.q_crow = torch.zeros(1, dtype=torch.int64, device=device)
+        self.q_cols = torch.empty(0, dtype=torch.int64, device=device)
+        self.values = torch.empty(0, device=device)
+        self.qt_cols = torch.empty((n_cells, max(capacity_workloads, 1)), dtype=torch.int64, device=device)
+        self._Q_csr = None
+        self.transposed = False
+    
+    @staticmethod
+    def _reserve(tensor, size):
+        """ tensor, grown geometrically along dim 0 to hold at least size entries """
+        if size <= tensor.size(0):
+            return tensor
+        grown = torch.empty((max(size, 2 * tensor.size(0)),) + tuple(tensor.shape[1:]), dtype=tensor.dtype, device=tensor.device)
+        grown[:tensor.size(0)] = tensor
+        return grown
+    
+    def append(self, query_idxes, num_queries):
+        """ Appends a workload of num_queries queries, where cell c answers query query_idxes[c].
+        Returns the CSR block of the new rows. """
+        query_idxes = torch.as_tensor(query_idxes, dtype=torch.int64, device=self._device)
+        assert query_idxes.shape == (self.n_cells,)
+        counts = torch.bincount(query_idxes, minlength=num_queries)
+        # cells grouped by query, in ascending order within each query
+        block_cols = torch.argsort(query_idxes, stable=True)
+        block_crow = torch.zeros(num_queries + 1, dtype=torch.int64, device=self._device)
+        torch.cumsum(counts, dim=0, out=block_crow[1:])
+        
+        self.q_crow = self._reserve(self.q_crow, self.n_rows + num_queries + 1)
+        self.q_cols = self._reserve(self.q_cols, self.nnz + self.n_cells)
+        self.values = self._reserve(self.values, self.nnz + self.n_cells)
+        if self.num_workloads == self.qt_cols.size(1):
+            qt_cols = torch.empty((self.n_cells, 2 * self.num_workloads), dtype=torch.int64, device=self._device)
+            qt_cols[:, :self.num_workloads] = self.qt_cols
+            self.qt_cols = qt_cols
+        
+        self.q_crow[self.n_rows + 1:self.n_rows + num_queries + 1] = self.nnz + block_crow[1:]
+        self.q_cols[self.nnz:self.nnz + self.n_cells] = block_cols
+        self.values[self.nnz:self.nnz + self.n_cells] = 1.0
+        self.qt_cols[:, self.num_workloads] = self.n_rows + query_idxes
+        self.n_rows += num_queries
+        self.nnz += self.n_cells
+        self.num_workloads += 1
+        self._Q_csr = None
+        
+        return torch.sparse_csr_tensor(block_crow, block_cols, torch.ones(self.n_cells, device=self._device),
+                                       size=(num_queries, self.n_cells), device=self._device)
+    
+    def append_workload(self, qm, workload):
+        """ Appends the full-table query matrix of a workload (see QueryManagerTorch.get_query_mat_full_table) """
+        offsets_t1 = qm.get_offsets(workload, 0).astype(np.int64)
+        offsets_t2 = qm.get_offsets(workload, 1).astype(np.int64)
+        return self.append(torch.from_numpy(np.add.outer(offsets_t1, offsets_t2).ravel()),
+                           qm.workload_dict[workload]["range_size"])
+    
+    @property
+    def T(self):
+        transposed = copy.copy(self)
+        transposed.transposed = not self.transposed
+        return transposed
+    
+    @property
+    def shape(self):
+        return torch.Size((self.n_cells, self.n_rows) if self.transposed else (self.n_rows, self.n_cells))
+    
+    @property
+    def device(self):
+        return self._device
+    
+    def size(self, dim=None):
+        return self.shape if dim is None else self.shape[dim]
+    
+    def Q_csr(self):
+        if self._Q_csr is None:
+            self._Q_csr = torch.sparse_csr_tensor(self.q_crow[:self.n_rows + 1], self.q_cols[:self.nnz], self.values[:self.nnz],
+                                                  size=(self.n_rows, self.n_cells), device=self._device)
+        return self._Q_csr
+    
+    def __matmul__(self, x):
+        if self.transposed:
+            return x[self.qt_cols[:, :self.num_workloads]].sum(dim=1)
+        return self.Q_csr() @ x
+
 class QueryManagerTorch(QueryManager):
     """
     Query manager implementation in Pytorch, containing several optimizations.
         - Lazy generation of workload query vectors
         - Support for slicing to learn subsections of the query
         - Sparse Pytorch storage of query vectors (using COO)
+        - Direct CSR construction of stacked slice query matrices
+        - Matrix-free query operators for large slices (KroneckerQueryOperator)
     """
-    def __init__(self, rel_dataset: RelationalDataset, k, df1_synth, df2_synth, device="cpu", otm=False, cache_query_matrices=False, verbose=False) -> None:
-        super().__init__(rel_dataset, k, df1_synth, df2_synth, verbose=verbose, otm=otm)
+    STATE_EXCLUDED = QueryManager.STATE_EXCLUDED + ("true_ans_tensor",)
+    
+    def __init__(self, rel_dataset: RelationalDataset, k, df1_synth, df2_synth, device="cpu", otm=False, cache_query_matrices=False, verbose=False,
+                 offset_cache_bytes=2**30) -> None:
+        super().__init__(rel_dataset, k, df1_synth, df2_synth, verbose=verbose, otm=otm, offset_cache_bytes=offset_cache_bytes)
         self.cache_query_matrices = cache_query_matrices
         self.device = device
         self.workload_query_answers = {}
         for workload in self.workload_names:
             self.workload_query_answers[workload] = None
-        self.true_ans_tensor = torch.from_numpy(np.concatenate(self.true_ans)).float()
+        self.true_ans_tensor = torch.from_numpy(self.true_ans_vec).float()
+    
+    @classmethod
+    def load_state(cls, path, rel_dataset, df1_synth, df2_synth, mmap_mode="r"):
+        qm = super().load_state(path, rel_dataset, df1_synth, df2_synth, mmap_mode=mmap_mode)
+        qm.true_ans_tensor = torch.from_numpy(np.asarray(qm.true_ans_vec, dtype=np.float32))
+        return qm
     def get_query_mat_full_table(self, workload):
         if self.workload_query_answers[workload] is not None:
             return self.workload_query_answers[workload]
@@ -409,6 +808,100 @@ class QueryManagerTorch(QueryManager):
         # TODO: there is no good reason for this to work this way?? This should not be necessary
         query_mat = torch.sparse_coo_tensor(indices, np.ones(shape=(vec_len, )), size=(num_queries, vec_len), device=self.device).float().coalesce()
         return query_mat, true_vals
+    def get_query_mat_sub_table_stacked(self, workloads, slices_t1, slices_t2):
+        """
+        Builds the query matrices of several workloads on a slice, stacked vertically in the given
+        order, together with the matching true answers.
+        
+        Every workload has exactly one nonzero per column, so both CSR layouts can be written
+        directly without sorting the (num_workloads * |slice1| * |slice2|) nonzeros:
+            - Q^T has W entries per row, and the stacked row indices of a column are already ascending.
+            - In Q_w, the row of cell (i, j) is offsets_t1[i] + offsets_t2[j]. Grouping the slice rows
+              of each table by their offset (a sort of |slice| entries) gives every nonzero's position
+              in the CSR arrays in closed form.
+        """
+        size_t1 = slices_t1.shape[0]
+        size_t2 = slices_t2.shape[0]
+        vec_len = size_t1 * size_t2
+        num_workloads = len(workloads)
+        
+        workload_idxes = [self.workload_index[w] for w in workloads]
+        offsets_t1 = self.get_workload_offsets(workload_idxes, 0)[:, slices_t1].astype(np.int64)
+        offsets_t2 = self.get_workload_offsets(workload_idxes, 1)[:, slices_t2].astype(np.int64)
+        range_sizes = np.array([self.workload_dict[w]["range_size"] for w in workloads], dtype=np.int64)
+        row_starts = np.concatenate(([0], np.cumsum(range_sizes)))
+        num_queries = int(row_starts[-1])
+        
+        # Q^T: the rows of column (i, j) are row_start_w + offsets_t1[w, i] + offsets_t2[w, j] for each w
+        qt_cols = offsets_t1.T[:, None, :] + offsets_t2.T[None, :, :] + row_starts[None, None, :-1]
+        qt_crow = np.arange(0, num_workloads * vec_len + 1, num_workloads, dtype=np.int64)
+        
+        q_crow = np.empty(num_queries + 1, dtype=np.int64)
+        q_crow[0] = 0
+        q_cols = np.empty(num_workloads * vec_len, dtype=np.int64)
+        all_counts_t1 = []
+        all_counts_t2 = []
+        for w_num, w in enumerate(workloads):
+            t2_dim = int(np.prod(self.workload_dict[w]["dim_2"])) # number of distinct t2 offsets
+            t1_dim = int(range_sizes[w_num]) // t2_dim
+            codes_t1 = offsets_t1[w_num] // t2_dim
+            codes_t2 = offsets_t2[w_num]
+            # slice rows grouped by code (stable, so columns stay ascending within each query)
+            order_t1 = np.argsort(codes_t1, kind='stable')
+            order_t2 = np.argsort(codes_t2, kind='stable')
+            counts_t1 = np.bincount(codes_t1, minlength=t1_dim)
+            counts_t2 = np.bincount(codes_t2, minlength=t2_dim)
+            all_counts_t1.append(counts_t1)
+            all_counts_t2.append(counts_t2)
+            starts_t1 = np.cumsum(counts_t1) - counts_t1
+            starts_t2 = np.cumsum(counts_t2) - counts_t2
+            # query (c1, c2) holds counts_t1[c1] * counts_t2[c2] cells
+            row_counts = np.outer(counts_t1, counts_t2).ravel()
+            q_crow[row_starts[w_num] + 1:row_starts[w_num + 1] + 1] = w_num * vec_len + np.cumsum(row_counts)
+            # position of cell (order_t1[p], order_t2[q]) inside this workload's block of nonzeros:
+            # earlier t1 groups, then earlier t2 groups of the same t1 group, then the row within the query
+            group_start_t1 = starts_t1[codes_t1[order_t1]]
+            group_size_t1 = counts_t1[codes_t1[order_t1]]
+            group_start_t2 = starts_t2[codes_t2[order_t2]]
+            group_size_t2 = counts_t2[codes_t2[order_t2]]
+            sorted_t1 = np.arange(size_t1)
+            sorted_t2 = np.arange(size_t2)
+            positions = (size_t2 * group_start_t1)[:, None] \
+                + group_size_t1[:, None] * group_start_t2[None, :] \
+                + (sorted_t1 - group_start_t1)[:, None] * group_size_t2[None, :] \
+                + (sorted_t2 - group_start_t2)[None, :]
+            block = q_cols[w_num * vec_len:(w_num + 1) * vec_len]
+            block[positions.ravel()] = (order_t1[:, None] * size_t2 + order_t2[None, :]).ravel()
+        
+        values = torch.ones(num_workloads * vec_len, device=self.device)
+        Q_csr = torch.sparse_csr_tensor(torch.from_numpy(q_crow), torch.from_numpy(q_cols), values,
+                                        size=(num_queries, vec_len), device=self.device)
+        QT_csr = torch.sparse_csr_tensor(torch.from_numpy(qt_crow), torch.from_numpy(qt_cols.reshape(-1)), values,
+                                         size=(vec_len, num_queries), device=self.device)
+        true_vals = torch.cat([self.get_true_answers(w) for w in workloads])
+        return SparseQueryMatrix(Q_csr, QT_csr, norm_bound=workload_spectral_norm_bound(all_counts_t1, all_counts_t2)), true_vals
+    def get_query_operator_sub_table(self, workloads, slices_t1, slices_t2):
+        """
+        Same as get_query_mat_sub_table_stacked, but returns a matrix-free KroneckerQueryOperator
+        that only stores the per-workload codes of the slice rows.
+        """
+        workload_idxes = [self.workload_index[w] for w in workloads]
+        offsets_t1 = self.get_workload_offsets(workload_idxes, 0)[:, slices_t1].astype(np.int64)
+        offsets_t2 = self.get_workload_offsets(workload_idxes, 1)[:, slices_t2].astype(np.int64)
+        
+        codes_t1 = []
+        codes_t2 = []
+        dims = []
+        for w_num, w in enumerate(workloads):
+            t2_dim = int(np.prod(self.workload_dict[w]["dim_2"]))
+            t1_dim = self.workload_dict[w]["range_size"] // t2_dim
+            codes_t1.append(torch.from_numpy(offsets_t1[w_num] // t2_dim).to(self.device))
+            codes_t2.append(torch.from_numpy(offsets_t2[w_num]).to(self.device))
+            dims.append((t1_dim, t2_dim))
+        
+        true_vals = torch.cat([self.get_true_answers(w) for w in workloads])
+        operator = KroneckerQueryOperator(codes_t1, codes_t2, dims, slices_t1.shape[0], slices_t2.shape[0], device=self.device)
+        return operator, true_vals
     def get_true_answers(self, workload):
         range_low = self.workload_dict[workload]["range_low"]
         range_high = self.workload_dict[workload]["range_high"] + 1
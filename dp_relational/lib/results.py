@@ -0,0 +1,154 @@
+""" Indexed store of run results, for analysing many runs without loading all of them.
+
+Runs are indexed in an append-only SQLite table holding their parameters, times, average error and
+artifact ids. Queries filter on the run set and on parameters inside SQLite; the per-workload error
+arrays of a selected run are only read from its artifact when they are first accessed. """
+
+import contextlib
+import json
+import os
+import pickle
+import sqlite3
+import time
+import uuid
+from collections.abc import Sequence
+
+from . import artifacts
+
+INDEX_FILE = "runs.sqlite"
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS runs (
+    run_id TEXT PRIMARY KEY,
+    run_set TEXT,
+    indexed_at REAL,
+    error_ave REAL,
+    parameters TEXT,
+    extra_params TEXT,
+    times TEXT,
+    artifacts TEXT,
+    path TEXT
+);
+CREATE INDEX IF NOT EXISTS runs_run_set ON runs (run_set);
+"""
+
+class LazyErrors(Sequence):
+    """ The per-workload error arrays of a saved run, read from disk on first access. Copies and
+    pickles of it are plain lists of the loaded arrays. """
+    def __init__(self, path):
+        self.path = path
+        self._errors = None
+
+    def load(self):
+        if self._errors is None:
+            self._errors = load_errors(self.path)
+        return self._errors
+
+    def __getitem__(self, idx):
+        return self.load()[idx]
+
+    def __len__(self):
+        return len(self.load())
+
+    def __reduce__(self):
+        return (list, (list(self.load()),))
+
+    def __repr__(self):
+        state = "loaded" if self._errors is not None else "not loaded"
+        return f"LazyErrors({self.path!r}, {state})"
+
+def load_errors(path):
+    """ The per-workload error arrays of the run saved at path (a run artifact or an older pickle) """
+    if artifacts.is_artifact(path):
+        return artifacts.load_run(path, load_errors=True)["errors"]
+    with open(path, "rb") as file_in:
+        return pickle.load(file_in)["errors"]
+
+def _dumps(value):
+    return json.dumps(artifacts.to_json(value))
+
+def _loads(text):
+    return json.loads(text, object_hook=artifacts.from_json)
+
+class RunIndex:
+    """
+    SQLite index of the runs saved in a runs folder. Connections are opened per operation, so an
+    index can be shared by the forked workers of a sweep.
+    """
+    def __init__(self, path):
+        self.path = path
+        with self.connect() as conn:
+            conn.executescript(SCHEMA)
+
+    @contextlib.contextmanager
+    def connect(self):
+        """ A connection for one operation: committed on success, and always closed """
+        with contextlib.closing(sqlite3.connect(self.path, timeout=60)) as conn:
+            conn.execute("PRAGMA journal_mode=WAL")
+            with conn:
+                yield conn
+
+    def add(self, run, path):
+        """ Indexes a run result saved at path; runs that are already indexed are left unchanged """
+        extra_params = run.get("extra_params") or {}
+        run_set = extra_params.get("run_set") if isinstance(extra_params, dict) else None
+        with self.connect() as conn:
+            conn.execute("INSERT OR IGNORE INTO runs VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)", (
+                str(run["run_id"]), run_set, time.time(), float(run["error_ave"]),
+                _dumps(run.get("parameters")), _dumps(extra_params), _dumps(run.get("times")),
+                _dumps(run.get("artifacts")), path))
+
+    def indexed_paths(self):
+        with self.connect() as conn:
+            return {row[0] for row in conn.execute("SELECT path FROM runs")}
+
+    def sync(self, runs_folder):
+        """ Indexes every run in runs_folder that is not indexed yet, e.g. runs saved before the index
+        existed. Only run manifests are read, except for runs pickled by older versions. """
+        if not os.path.isdir(runs_folder):
+            return
+        indexed = self.indexed_paths()
+        for fname in os.listdir(runs_folder):
+            path = os.path.join(runs_folder, fname)
+            if path in indexed:
+                continue
+            if artifacts.is_artifact(path):
+                self.add(artifacts.load_run(path, load_errors=False), path)
+            elif fname.endswith(".pkl"):
+                with open(path, "rb") as file_in:
+                    self.add(pickle.load(file_in), path)
+
+    def query(self, run_set=None, run_set_prefix=None, info=None, **parameters):
+        """
+        Returns the runs matching every given filter, as run result dicts whose "errors" is a LazyErrors:
+        run_set: exact run set name; run_set_prefix: run sets starting with this string;
+        info: dict of values required in extra_params["info"]; any other keyword is a required value
+        of run["parameters"].
+        """
+        conditions = []
+        values = []
+        if run_set is not None:
+            conditions.append("run_set = ?")
+            values.append(run_set)
+        if run_set_prefix is not None:
+            conditions.append("substr(run_set, 1, ?) = ?")
+            values += [len(run_set_prefix), run_set_prefix]
+        for column, filters in (("parameters", parameters), ("extra_params", {f"info.{k}": v for k, v in (info or {}).items()})):
+            for name, value in filters.items():
+                conditions.append(f"json_extract({column}, ?) = ?")
+                values += [f"$.{name}", value]
+        sql = "SELECT run_id, error_ave, parameters, extra_params, times, artifacts, path FROM runs"
+        if conditions:
+            sql += " WHERE " + " AND ".join(conditions)
+        sql += " ORDER BY indexed_at"
+        with self.connect() as conn:
+            rows = conn.execute(sql, values).fetchall()
+        return [{
+            "run_id": uuid.UUID(run_id),
+            "parameters": _loads(parameters),
+            "extra_params": _loads(extra_params),
+            "times": _loads(times),
+            "error_ave": error_ave,
+            "errors": LazyErrors(path),
+            "artifacts": _loads(run_artifacts),
+        } for run_id, error_ave, parameters, extra_params, times, run_artifacts, path in rows]
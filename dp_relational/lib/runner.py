@@ -2,11 +2,19 @@ import dp_relational
 import dp_relational.data.movies
 import dp_relational.lib.qm
 import dp_relational.lib.synth_data
+from dp_relational.lib.cache import ArtifactCache, fingerprint, library_fingerprint
+from dp_relational.lib import artifacts
+from dp_relational.lib.results import RunIndex, INDEX_FILE
 
 import numpy as np
+import torch
 import time
 import uuid
 import pickle
+import random
+import inspect
+import itertools
+import multiprocessing
 
 import os
 from pathlib import Path
@@ -17,6 +25,73 @@ DATASET_FOLDER = "datasets"
 SYNTABLES_FOLDER = "syntables"
 RELATIONSHIPS_FOLDER = "relationships"
 RUNS_FOLDER = "runs"
+CACHE_FOLDER = "cache"
+# file holding the run id of a cached stage output, next to its artifact files
+CACHE_RUN_ID_FILE = "run_id"
+
+# stages whose outputs are reused from the artifact cache by default. The DP synthetic tables and the
+# relationship tables are opt-in, since repeating a run with the same parameters is usually meant to
+# draw a new sample. The query manager is still reused, as it is keyed on the synthetic tables' run id.
+DEFAULT_CACHED_STAGES = ("dataset", "qm")
+# stages whose output is a deterministic function of their stage key, so a forced regeneration with
+# unchanged inputs is still served from the cache rather than recomputed
+DETERMINISTIC_STAGES = ("qm",)
+
+class FuncTimer(object):
+    def __init__(self, objin, name):
+        self.objin = objin
+        self.name = name
+    def __enter__(self):
+        self.time_start = time.perf_counter()
+    def __exit__(self, exception_type, exception_value, traceback):
+        time_end = time.perf_counter()
+        self.objin[self.name] = time_end - self.time_start
+
+def expand_grid(grid):
+    """ A parameter grid is either a list of parameter dicts, or a dict mapping each parameter
+    to a list of values, which is expanded to every combination of values """
+    if isinstance(grid, dict):
+        return [dict(zip(grid.keys(), values)) for values in itertools.product(*grid.values())]
+    return [dict(point) for point in grid]
+
+def _run_sweep_point(state, task):
+    index, point, seed = task
+    runner, configure, extra_params, save_to = state
+    # workers start from copies of the same random state, so each run is reseeded
+    random.seed(seed)
+    np.random.seed(seed)
+    torch.manual_seed(seed)
+    
+    update_params = inspect.signature(runner.update).parameters
+    runner.update(**{key: value for key, value in point.items() if key in update_params})
+    if configure is not None:
+        configure(point)
+    # every point is a separate run, even when only configure() changed the strategy's hyperparameters
+    runner.regenerate_cross_answers = True
+    
+    run_params = extra_params(point) if callable(extra_params) else dict(extra_params)
+    run_params["sweep_point"] = point
+    return index, runner.run(extra_params=run_params, save_to=save_to)
+
+# (runner, configure, extra_params, save_to) of the sweep a pool worker belongs to, set by _sweep_init
+_worker_state = None
+
+def _sweep_init(runner, configure, extra_params, save_to, devices, num_threads):
+    """ Pool initializer: each worker takes one device off the devices queue, if there is one, and
+    limits torch to its share of the intra-op threads """
+    global _worker_state
+    torch.set_num_threads(num_threads)
+    if devices is not None:
+        device = torch.device(devices.get())
+        if device.type == "cuda":
+            torch.cuda.set_device(device)
+        runner.device = device
+        if runner.qm is not None and hasattr(runner.qm, "device"):
+            runner.qm.device = device
+    _worker_state = (runner, configure, extra_params, save_to)
+
+def _sweep_worker(task):
+    return _run_sweep_point(_worker_state, task)
 
 class ModelRunner:
     """
@@ -26,11 +101,27 @@ class ModelRunner:
 
     It also supports reading previously saved results, and also reading intermediate
     values (e.g. the original individual synthetic tables) to speed up computation.
+    
+    Stage outputs are also kept in a content-addressed cache (see dp_relational.lib.cache), keyed by
+    the inputs of each stage, so they are reused automatically whenever the inputs match. cache may be
+    True (a store in save_to), False, a directory or an ArtifactCache; cache_stages selects the stages
+    out of "dataset", "syn_tables", "qm" and "relationships" that use it. A randomized stage that is
+    forced to regenerate without any change to its inputs (e.g. by setting regenerate_syn_tables)
+    skips the cache and draws a fresh output; the query manager is deterministic, so setting
+    regenerate_qm still reuses the cached one.
     """
-    def __init__(self, save_to="./runs", self_relation=False, *args, **kwargs) -> None:
+    def __init__(self, save_to="./runs", self_relation=False, *args, cache=True,
+                 cache_stages=DEFAULT_CACHED_STAGES, **kwargs) -> None:
         self.save_to = save_to
         self.self_relation = self_relation
         
+        if cache is True:
+            cache = ArtifactCache(os.path.join(save_to, CACHE_FOLDER))
+        elif isinstance(cache, (str, os.PathLike)):
+            cache = ArtifactCache(cache)
+        self.cache = cache or None
+        self.cache_stages = tuple(cache_stages)
+        
         self.dataset_generator = None
         self.n_syn1 = None
         self.n_syn2 = None
@@ -58,8 +149,12 @@ class ModelRunner:
         
         self.relationship_syn_runid = -1
         self.relationship_syn = None
+        # stage -> stage_key of the output currently held for that stage
+        self.current_keys = {}
         
         self.T = None
+        # device assigned to this runner's worker by sweep(devices=...)
+        self.device = None
         
         self.update(*args, **kwargs)
     
@@ -128,102 +223,288 @@ class ModelRunner:
             "T": self.T
         }
     
-    def get_experiments(self, save_to=None):
+    def stage_key(self, stage):
+        """ Fingerprint of the inputs of a stage, including the keys and run ids of the stages it
+        depends on, and the library source """
+        if stage == "dataset":
+            inputs = (self.dataset_generator, self.dmax)
+        elif stage == "syn_tables":
+            inputs = (self.stage_key("dataset"), str(self.rel_dataset_runid), self.n_syn1, self.n_syn2,
+                      self.synth, self.eps1, self.eps2, self.self_relation)
+        elif stage == "qm":
+            # the run id identifies the DP draw of the synthetic tables, which the parameters do not
+            inputs = (self.stage_key("syn_tables"), str(self.synth_tables_runid), self.qm_generator, self.k)
+        elif stage == "relationships":
+            inputs = (self.stage_key("qm"), self.cross_generation_strategy, self.epsilon, self.eps1, self.eps2,
+                      self.T)
+        else:
+            raise ValueError(f"unknown stage {stage}")
+        return fingerprint(stage, library_fingerprint(), *inputs)
+    
+    def cache_lookup(self, stage):
+        """ Whether a regeneration of the stage may be served from the cache: only if it uses the cache,
+        and either it is deterministic or its inputs changed since its current output was made.
+        Otherwise the regeneration was forced to draw a fresh output. """
+        if self.cache is None or stage not in self.cache_stages:
+            return False
+        return stage in DETERMINISTIC_STAGES or self.current_keys.get(stage) != self.stage_key(stage)
+    
+    def cache_get_dir(self, stage):
+        if not self.cache_lookup(stage):
+            return None
+        return self.cache.get_dir(stage, self.stage_key(stage))
+    
+    def cache_put_dir(self, stage, write):
+        if self.cache is not None and stage in self.cache_stages:
+            self.cache.put_dir(stage, self.stage_key(stage), write)
+    
+    def cache_get_artifact(self, stage, load):
+        """ Returns (run id, output) if the output of the stage for the current inputs is cached, reading
+        the artifact back (memory-mapped) with load(path); otherwise None """
+        entry = self.cache_get_dir(stage)
+        if entry is None:
+            return None
+        with open(os.path.join(entry, CACHE_RUN_ID_FILE)) as file_in:
+            run_id = uuid.UUID(file_in.read())
+        return run_id, load(entry)
+    
+    def cache_put_artifact(self, stage, run_id, save):
+        """ Caches the output of the stage as an artifact directory, written by save(path) """
+        def write(path):
+            save(path)
+            with open(os.path.join(path, CACHE_RUN_ID_FILE), "w") as file_out:
+                file_out.write(str(run_id))
+        self.cache_put_dir(stage, write)
+    
+    def get_experiments(self, save_to=None, load_errors=True):
+        """ Reads the results of every saved run. Only the run manifests are parsed: the error arrays
+        are memory-mapped (or skipped with load_errors=False). Runs pickled by older versions are
+        also read. """
         if save_to is None:
             save_to = self.save_to
         fpath = os.path.join(save_to, "runs")
         files = os.listdir(fpath)
         run_data = []
         for file in files:
-            with open(os.path.join(fpath, file), "rb") as file_reader:
-                run_data.append(pickle.load(file_reader))
+            run_path = os.path.join(fpath, file)
+            if artifacts.is_artifact(run_path):
+                run_data.append(artifacts.load_run(run_path, load_errors=load_errors))
+            elif file.endswith(".pkl"):
+                with open(run_path, "rb") as file_reader:
+                    run_data.append(pickle.load(file_reader))
         return run_data
     
+    def run_index(self, save_to=None):
+        """ The SQLite index of the runs saved in save_to (see dp_relational.lib.results) """
+        if save_to is None:
+            save_to = self.save_to
+        os.makedirs(save_to, exist_ok=True)
+        return RunIndex(os.path.join(save_to, INDEX_FILE))
+    
+    def query_experiments(self, save_to=None, run_set=None, run_set_prefix=None, info=None, **parameters):
+        """ Like get_experiments, but only returns the runs matching the given filters (see
+        RunIndex.query), e.g. query_experiments(run_set="0", epsilon=4.0). Filtering happens in the
+        run index, and the error arrays of a run are only read when its "errors" are accessed. """
+        if save_to is None:
+            save_to = self.save_to
+        index = self.run_index(save_to)
+        index.sync(os.path.join(save_to, RUNS_FOLDER))
+        return index.query(run_set=run_set, run_set_prefix=run_set_prefix, info=info, **parameters)
+    
     def load_artifacts(self, experiment_id, save_to=None):
-        # try to find an artifact for each section
-        dataset_path = os.path.join(self.save_to, DATASET_FOLDER, experiment_id + ".pkl")
-        if os.path.isfile(dataset_path):
+        if save_to is None:
+            save_to = self.save_to
+        # try to find an artifact for each section, in the columnar format or as an older pickle
+        dataset_path = os.path.join(save_to, DATASET_FOLDER, experiment_id)
+        if artifacts.is_artifact(dataset_path) or os.path.isfile(dataset_path + ".pkl"):
             print("Loaded dataset!")
-            with open(dataset_path, "rb") as file_in:
-                self.rel_dataset = pickle.load(file_in)
+            if artifacts.is_artifact(dataset_path):
+                self.rel_dataset = artifacts.load_dataset(dataset_path)
+            else:
+                with open(dataset_path + ".pkl", "rb") as file_in:
+                    self.rel_dataset = pickle.load(file_in)
             self.regenerate_dataset = False
             self.rel_dataset_runid = uuid.UUID(experiment_id)
             
-        syntable_path = os.path.join(self.save_to, SYNTABLES_FOLDER, experiment_id + ".pkl")
-        if os.path.isfile(syntable_path):
+        syntable_path = os.path.join(save_to, SYNTABLES_FOLDER, experiment_id)
+        if artifacts.is_artifact(syntable_path) or os.path.isfile(syntable_path + ".pkl"):
             print("Loaded syntables!")
-            with open(syntable_path, "rb") as file_in:
-                dfs = pickle.load(file_in)
-                self.df1_synth = dfs[0]
-                self.df2_synth = dfs[1]
+            if artifacts.is_artifact(syntable_path):
+                dfs = artifacts.load_tables(syntable_path)
+            else:
+                with open(syntable_path + ".pkl", "rb") as file_in:
+                    dfs = pickle.load(file_in)
+            self.df1_synth = dfs[0]
+            self.df2_synth = dfs[1]
             self.regenerate_syn_tables = False
             self.synth_tables_runid = uuid.UUID(experiment_id)
         
         # TODO: load other artifacts...
     
-    def run(self, extra_params={}, save_to=None):
+    def prepare_tables(self, save_to=None, run_id=None):
+        """ Runs the dataset and individual synthetic table stages, if they need to be regenerated """
         if save_to is None:
             save_to = self.save_to
-        curr_run_id = uuid.uuid1()
-        
-        self.times = {}
-        
-        class FuncTimer(object):
-            def __init__(self, objin, name):
-                self.objin = objin
-                self.name = name
-            def __enter__(self):
-                self.time_start = time.perf_counter()
-            def __exit__(self, exception_type, exception_value, traceback):
-                time_end = time.perf_counter()
-                self.objin[self.name] = time_end - self.time_start
+        curr_run_id = uuid.uuid1() if run_id is None else run_id
+        if not hasattr(self, "times"):
+            self.times = {}
         
         if self.regenerate_dataset:
             self.regenerate_dataset = False
-            self.rel_dataset_runid = curr_run_id
-            with FuncTimer(self.times, "dataset_generation"):
-                self.rel_dataset = self.dataset_generator(self.dmax)
-            # save it
-            fpath = os.path.join(save_to, DATASET_FOLDER)
-            os.makedirs(fpath, exist_ok=True)
-            with open(os.path.join(fpath, f"{curr_run_id}.pkl"), 'wb') as f:
-                pickle.dump(self.rel_dataset, f)
+            self.regenerate_syn_tables = True
+            cached = self.cache_get_artifact("dataset", artifacts.load_dataset)
+            if cached is not None:
+                self.rel_dataset_runid, self.rel_dataset = cached
+            else:
+                self.rel_dataset_runid = curr_run_id
+                with FuncTimer(self.times, "dataset_generation"):
+                    self.rel_dataset = self.dataset_generator(self.dmax)
+                # save it
+                artifacts.save_dataset(os.path.join(save_to, DATASET_FOLDER, str(curr_run_id)), self.rel_dataset)
+                self.cache_put_artifact("dataset", self.rel_dataset_runid,
+                                        lambda path: artifacts.save_dataset(path, self.rel_dataset))
+            self.current_keys["dataset"] = self.stage_key("dataset")
         
         if self.regenerate_syn_tables:
             self.regenerate_syn_tables = False
-            self.synth_tables_runid = curr_run_id
-            print(curr_run_id)
-            with FuncTimer(self.times, "synth_table_generation"):
-                if not self.self_relation:
-                    self.df1_synth = dp_relational.lib.synth_data.compute_single_table_synth_data(
-                        self.rel_dataset.table1.df, self.n_syn1, self.synth, epsilon=self.eps1)
-                    self.df2_synth = dp_relational.lib.synth_data.compute_single_table_synth_data(
-                        self.rel_dataset.table2.df, self.n_syn2, self.synth, epsilon=self.eps2)
-                else:
-                    self.df1_synth = dp_relational.lib.synth_data.compute_single_table_synth_data(
-                        self.rel_dataset.table1.df, self.n_syn1, self.synth, epsilon=self.eps1)
-                    self.df2_synth = self.df1_synth.copy()
-            # save it
-            fpath = os.path.join(save_to, SYNTABLES_FOLDER)
-            os.makedirs(fpath, exist_ok=True)
-            with open(os.path.join(fpath, f"{curr_run_id}.pkl"), 'wb') as f:
-                pickle.dump([self.df1_synth, self.df2_synth], f)
-        
+            self.regenerate_qm = True
+            cached = self.cache_get_artifact("syn_tables", artifacts.load_tables)
+            if cached is not None:
+                self.synth_tables_runid, (self.df1_synth, self.df2_synth) = cached
+            else:
+                self.synth_tables_runid = curr_run_id
+                print(curr_run_id)
+                with FuncTimer(self.times, "synth_table_generation"):
+                    if not self.self_relation:
+                        self.df1_synth = dp_relational.lib.synth_data.compute_single_table_synth_data(
+                            self.rel_dataset.table1.df, self.n_syn1, self.synth, epsilon=self.eps1)
+                        self.df2_synth = dp_relational.lib.synth_data.compute_single_table_synth_data(
+                            self.rel_dataset.table2.df, self.n_syn2, self.synth, epsilon=self.eps2)
+                    else:
+                        self.df1_synth = dp_relational.lib.synth_data.compute_single_table_synth_data(
+                            self.rel_dataset.table1.df, self.n_syn1, self.synth, epsilon=self.eps1)
+                        self.df2_synth = self.df1_synth.copy()
+                # save it
+                artifacts.save_tables(os.path.join(save_to, SYNTABLES_FOLDER, str(curr_run_id)),
+                                      [self.df1_synth, self.df2_synth], kind="syn_tables")
+                self.cache_put_artifact("syn_tables", self.synth_tables_runid, lambda path: artifacts.save_tables(
+                    path, [self.df1_synth, self.df2_synth], kind="syn_tables"))
+            self.current_keys["syn_tables"] = self.stage_key("syn_tables")
+    
+    def prepare_query_manager(self):
+        """ Runs the query manager stage, if it needs to be regenerated """
+        if not hasattr(self, "times"):
+            self.times = {}
         if self.regenerate_qm:
             self.regenerate_qm = False
-            with FuncTimer(self.times, "qm_init"):
-                self.qm = self.qm_generator(self.rel_dataset, k=self.k, df1_synth=self.df1_synth, df2_synth=self.df2_synth)
+            self.regenerate_cross_answers = True
+            # the query manager is cached as its saved state, which is memory-mapped back in
+            state_dir = self.cache_get_dir("qm")
+            if state_dir is not None:
+                self.qm = dp_relational.lib.qm.load_query_manager(state_dir, self.rel_dataset, self.df1_synth, self.df2_synth)
+            else:
+                with FuncTimer(self.times, "qm_init"):
+                    self.qm = self.qm_generator(self.rel_dataset, k=self.k, df1_synth=self.df1_synth, df2_synth=self.df2_synth)
+                self.cache_put_dir("qm", self.qm.save_state)
+            self.current_keys["qm"] = self.stage_key("qm")
+    
+    def uses_cuda(self):
+        device = getattr(self.qm, "device", None)
+        return torch.cuda.is_initialized() or (device is not None and torch.device(device).type == "cuda")
+    
+    def sweep(self, grid, processes=None, configure=None, extra_params={}, save_to=None, seed=None, on_result=None,
+              devices=None):
+        """
+        Runs every point of a parameter grid (see expand_grid) over a pool of worker processes.
+        
+        The dataset, individual synthetic tables and query manager are built once here, before the workers
+        start, so all workers share them. Keys of a point that update() accepts are applied to the runner
+        (points changing the query manager's inputs make each worker build its own). configure(point) is
+        called in the worker afterwards, e.g. to set hyperparameters that the cross generation strategy reads
+        from globals. extra_params is stored with every run, or may be a function of the point; the point
+        itself is stored as extra_params["sweep_point"].
+        
+        Without devices, workers are forked (CPU runs; processes defaults to the number of CPUs). Forked
+        workers cannot use CUDA, so when the query manager is on a CUDA device, or CUDA is already initialized,
+        the points run one after another in this process instead.
+        With devices (e.g. ["cuda:0", "cuda:1"]), one worker is spawned per entry and assigned that device,
+        which is set as runner.device and qm.device in the worker; repeat a device to run several workers on
+        it. Spawned workers re-import the calling script, which must guard its top-level code with
+        if __name__ == "__main__", and the runner (with its generators) must be picklable.
+        
+        on_result(point, result) is called in this process as runs finish. Returns the run results in grid
+        order.
+        """
+        if save_to is None:
+            save_to = self.save_to
+        points = expand_grid(grid)
+        seeds = np.random.SeedSequence(seed).generate_state(len(points))
+        tasks = [(index, point, int(point_seed)) for index, (point, point_seed) in enumerate(zip(points, seeds))]
+        
+        self.prepare_tables(save_to)
+        self.prepare_query_manager()
+        
+        results = [None] * len(points)
+        def collect(index, result):
+            results[index] = result
+            if on_result is not None:
+                on_result(points[index], result)
+        
+        if devices is None and (processes == 1 or self.uses_cuda()):
+            state = (self, configure, extra_params, save_to)
+            for task in tasks:
+                collect(*_run_sweep_point(state, task))
+            return results
+        
+        if devices is None:
+            # the query manager was just built with torch's intra-op (OpenMP) threads in this process.
+            # Forked children start with only the forking thread, and some OpenMP runtimes hang on their
+            # first parallel region after such a fork; pass devices=["cpu", ...] to spawn fresh workers
+            # instead if that happens.
+            context = multiprocessing.get_context("fork")
+            device_queue = None
+            processes = processes or os.cpu_count()
+        else:
+            context = multiprocessing.get_context("spawn")
+            device_queue = context.Queue()
+            for device in devices:
+                device_queue.put(str(device))
+            processes = len(devices)
+        # the workers split this process's intra-op threads, rather than each starting that many
+        num_threads = max(1, torch.get_num_threads() // processes)
+        with context.Pool(processes, initializer=_sweep_init,
+                          initargs=(self, configure, extra_params, save_to, device_queue, num_threads)) as pool:
+            for index, result in pool.imap_unordered(_sweep_worker, tasks):
+                collect(index, result)
+        return results
+    
+    def run(self, extra_params={}, save_to=None):
+        if save_to is None:
+            save_to = self.save_to
+        curr_run_id = uuid.uuid1()
+        # extra_params are saved in the run manifest: fail now rather than after the run if they cannot be
+        artifacts.to_json(extra_params)
+        
+        self.times = {}
+        
+        self.prepare_tables(save_to, curr_run_id)
+        self.prepare_query_manager()
         
         if self.regenerate_cross_answers:
             self.regenerate_cross_answers = False
-            self.relationship_syn_runid = curr_run_id
-            with FuncTimer(self.times, "cross_answers_gen"):
-                self.relationship_syn = self.cross_generation_strategy(self.qm, self.epsilon - self.eps1 - self.eps2, T=self.T)
-            # save it
-            fpath = os.path.join(save_to, RELATIONSHIPS_FOLDER)
-            os.makedirs(fpath, exist_ok=True)
-            with open(os.path.join(fpath, f"{curr_run_id}.pkl"), 'wb') as f:
-                pickle.dump(self.relationship_syn, f)
+            cached = self.cache_get_artifact("relationships", artifacts.load_tables)
+            if cached is not None:
+                self.relationship_syn_runid, (self.relationship_syn,) = cached
+            else:
+                self.relationship_syn_runid = curr_run_id
+                with FuncTimer(self.times, "cross_answers_gen"):
+                    self.relationship_syn = self.cross_generation_strategy(self.qm, self.epsilon - self.eps1 - self.eps2, T=self.T)
+                # save it
+                artifacts.save_tables(os.path.join(save_to, RELATIONSHIPS_FOLDER, str(curr_run_id)),
+                                      [self.relationship_syn], kind="relationships")
+                self.cache_put_artifact("relationships", self.relationship_syn_runid, lambda path: artifacts.save_tables(
+                    path, [self.relationship_syn], kind="relationships"))
+            self.current_keys["relationships"] = self.stage_key("relationships")
         
         ave_error, errors = dp_relational.lib.synth_data.evaluate_synthetic_rel_table(self.qm, self.relationship_syn)
         to_return = {
@@ -239,9 +520,8 @@ class ModelRunner:
                 "relationship_syn": self.relationship_syn_runid
             }
         }
-        fpath = os.path.join(save_to, RUNS_FOLDER)
-        os.makedirs(fpath, exist_ok=True)
-        with open(os.path.join(fpath, f"{curr_run_id}.pkl"), 'wb') as f:
-            pickle.dump(to_return, f)
+        run_path = os.path.join(save_to, RUNS_FOLDER, str(curr_run_id))
+        artifacts.save_run(run_path, to_return)
+        self.run_index(save_to).add(to_return, run_path)
         
         return to_return
\ No newline at end of file
@@ -4,17 +4,19 @@
 from snsynth import Synthesizer
 from .dataset import RelationalDataset
 import itertools
+import os
 import random
 import numpy as np
 import pandas as pd
 
 import torch
 
-from .helpers import cdp_delta, cdp_eps, cdp_rho, get_per_round_privacy_budget, torch_cat_sparse_coo, get_relationships_from_sparse
+from .helpers import cdp_delta, cdp_eps, cdp_rho, get_per_round_privacy_budget, torch_cat_sparse_coo, get_relationships_from_sparse, RelationshipSet
 
 from tqdm import tqdm
 
 from .qm import QueryManager, QueryManagerBasic, QueryManagerTorch
+from . import artifacts
 
 import gc
 
@@ -68,37 +70,106 @@ from .synth_strategies.torch_pgd import learn_relationship_vector_torch_pgd
 
 from .synth_strategies.torch_pgd_otm import learn_relationship_vector_torch_pgd_otm
 
-def make_synthetic_rel_table(qm: QueryManager, b_round):
-    ID_1 = qm.rel_dataset.rel_id1_col
-    ID_2 = qm.rel_dataset.rel_id2_col
+# relationships exported per chunk when streaming a relationship table to disk
+REL_TABLE_CHUNK_SIZE = 1 << 22
+
+def _relationship_chunks(qm: QueryManager, b_round, chunk_size):
+    """
+    Returns (n_relationships, chunks) for any representation of the synthetic relationships, where
+    chunks() yields (table1_idx, table2_idx) int64 arrays of at most about chunk_size relationships.
+    b_round may be a RelationshipSet, a sparse COO tensor over the flattened cross product, a dense
+    0/1 array or tensor (n_syn1 x n_syn2, or flattened), or an edge list (table1_idx, table2_idx).
+    """
+    n_syn2 = qm.n_syn2
+    def split_keys(keys):
+        def chunks():
+            for start in range(0, len(keys), chunk_size):
+                key_chunk = np.asarray(keys[start:start + chunk_size], dtype=np.int64)
+                yield key_chunk // n_syn2, key_chunk % n_syn2
+        return len(keys), chunks
     
-    relationship_syn = pd.DataFrame(columns=[ID_1, ID_2])
-
-    for i in range(qm.n_syn1):
-        for j in range(qm.n_syn2):
-            if b_round[i,j] == 1:
-                new_data = pd.DataFrame([{ID_1: i, ID_2: j}])
-                relationship_syn = pd.concat([relationship_syn, new_data], ignore_index=True)
+    if isinstance(b_round, RelationshipSet):
+        return split_keys(b_round.keys)
+    if isinstance(b_round, (tuple, list)):
+        table1_nums, table2_nums = (np.asarray(torch.as_tensor(idx).cpu(), dtype=np.int64).ravel() for idx in b_round)
+        def edge_chunks():
+            for start in range(0, len(table1_nums), chunk_size):
+                yield table1_nums[start:start + chunk_size], table2_nums[start:start + chunk_size]
+        return len(table1_nums), edge_chunks
+    if isinstance(b_round, torch.Tensor) and b_round.is_sparse:
+        b_round = b_round.coalesce()
+        indices = b_round.indices()[:, b_round.values() != 0]
+        keys = indices[0] if b_round.dim() == 1 else indices[0] * n_syn2 + indices[1]
+        return split_keys(keys.cpu().numpy())
     
-    return relationship_syn
-
-def make_synthetic_rel_table_sparse(qm: QueryManager, b_round: torch.Tensor):
+    # dense indicator matrix: nonzero() is taken over blocks of whole rows
+    dense = b_round if isinstance(b_round, torch.Tensor) else np.asarray(b_round)
+    dense = dense.reshape(qm.n_syn1, n_syn2)
+    rows_per_chunk = max(1, chunk_size // max(n_syn2, 1))
+    if isinstance(dense, torch.Tensor):
+        n_relationships = int(torch.count_nonzero(dense))
+    else:
+        n_relationships = int(np.count_nonzero(dense))
+    def dense_chunks():
+        for start in range(0, qm.n_syn1, rows_per_chunk):
+            block = dense[start:start + rows_per_chunk]
+            if isinstance(block, torch.Tensor):
+                table1_nums, table2_nums = (idx.cpu().numpy() for idx in torch.nonzero(block, as_tuple=True))
+            else:
+                table1_nums, table2_nums = np.nonzero(block)
+            yield table1_nums.astype(np.int64) + start, table2_nums.astype(np.int64)
+    return n_relationships, dense_chunks
+
+def make_synthetic_rel_table(qm: QueryManager, b_round, path=None, chunk_size=REL_TABLE_CHUNK_SIZE):
+    """
+    Exports the synthetic relationships b_round (in any format accepted by _relationship_chunks) as
+    a table of (ID_1, ID_2) pairs.
+    Without a path, the table is returned as a DataFrame. With a path, it is streamed to disk one
+    chunk at a time as a relationship table artifact (see dp_relational.lib.artifacts), and the path
+    is returned; the table can then be memory-mapped with artifacts.load_tables(path)[0].
+    """
     ID_1 = qm.rel_dataset.rel_id1_col
     ID_2 = qm.rel_dataset.rel_id2_col
     
-    table1_nums, table2_nums = get_relationships_from_sparse(qm, b_round)
+    n_relationships, chunks = _relationship_chunks(qm, b_round, chunk_size)
+    if path is None:
+        table1_nums = np.empty(n_relationships, dtype=np.int64)
+        table2_nums = np.empty(n_relationships, dtype=np.int64)
+    else:
+        os.makedirs(path, exist_ok=True)
+        table1_nums = np.lib.format.open_memmap(os.path.join(path, "t0_col0.npy"), mode="w+", dtype=np.int64, shape=(n_relationships,))
+        table2_nums = np.lib.format.open_memmap(os.path.join(path, "t0_col1.npy"), mode="w+", dtype=np.int64, shape=(n_relationships,))
+    
+    filled = 0
+    for table1_chunk, table2_chunk in chunks():
+        table1_nums[filled:filled + len(table1_chunk)] = table1_chunk
+        table2_nums[filled:filled + len(table2_chunk)] = table2_chunk
+        filled += len(table1_chunk)
+    assert filled == n_relationships
     
-    relationship_syn = pd.DataFrame(data={
-        ID_1: table1_nums,
-        ID_2: table2_nums
+    if path is None:
+        return pd.DataFrame(data={
+            ID_1: table1_nums,
+            ID_2: table2_nums
+        })
+    table1_nums.flush()
+    table2_nums.flush()
+    del table1_nums, table2_nums
+    artifacts.write_manifest(path, {
+        "kind": "relationships",
+        "tables": [{"columns": [{"name": ID_1, "file": "t0_col0.npy"}, {"name": ID_2, "file": "t0_col1.npy"}],
+                    "n_rows": n_relationships}],
     })
+    return path
 
-    return relationship_syn
+def make_synthetic_rel_table_sparse(qm: QueryManager, b_round: torch.Tensor):
+    return make_synthetic_rel_table(qm, b_round)
 
 def evaluate_synthetic_rel_table(qm: QueryManager, relationship_syn):
-    ans_syn = qm.calculate_ans_from_rel_dataset(relationship_syn, is_synth=True)
+    ans_syn = qm.calculate_ans_vector(relationship_syn, is_synth=True)
     
-    errors = [np.abs(ans_syn[i] - qm.true_ans[i]) for i in range(len(ans_syn))]
-    ave_error = 100 * np.mean(np.array([np.sum(x) for x in errors]))
+    abs_errors = np.abs(ans_syn - qm.true_ans_vec)
+    errors = qm.split_workloads(abs_errors)
+    ave_error = 100 * np.mean(np.add.reduceat(abs_errors, qm.range_lows))
     
     return (ave_error, errors)
\ No newline at end of file
@@ -1,7 +1,7 @@
 import numpy as np
 import torch
-from ..qm import QueryManager, QueryManagerBasic, QueryManagerTorch
-from ..helpers import cdp_delta, cdp_eps, cdp_rho, get_per_round_privacy_budget, torch_cat_sparse_coo
+from ..qm import QueryManager, QueryManagerBasic, QueryManagerTorch, StackedQueryMatrix
+from ..helpers import cdp_delta, cdp_eps, cdp_rho, get_per_round_privacy_budget
 
 
 from ..helpers import expround_torch, GM_torch_noise, GM_torch, mosek_optimize, mirror_descent_torch
@@ -17,11 +17,16 @@ import gc
 @torch.no_grad()
 def learn_relationship_vector_torch(qm: QueryManagerTorch, epsilon_relationship=1.0, T=100, T_mirror=50,
                                     num_workload_ite = 2, delta_relationship = 1e-5,
-                                    verbose=False, device="cpu"):
+                                    verbose=False, device="cpu", mirror_tol=1e-6):
     """
     This is a basic algorithm for learning a relationship vector.
     This samples new workloads each iteration randomly, and then uses a mirror descent to find the new relationship vector.
     Same as basic_algo.py, but using torch
+    
+    The selected workloads are appended to a StackedQueryMatrix, and each mirror descent is warm
+    started from the previous b and its cached Qb (only the new rows are multiplied). It stops after
+    T_mirror iterations, or earlier once the objective changes by less than mirror_tol (relative;
+    None always runs T_mirror iterations).
     """
     n_relationship_orig = qm.n_relationship_orig
     n_relationship_synt = qm.n_relationship_synth
@@ -41,9 +46,11 @@ def learn_relationship_vector_torch(qm: QueryManagerTorch, epsilon_relationship=
 
     # intialization
     unselected_workload = [i for i in range(len(qm.workload_names))]
-    Q_set = torch.empty((0, qm.n_syn1 * qm.n_syn2)).to_sparse_coo().to(device=device).float().coalesce()
+    Q_set = StackedQueryMatrix(qm.n_syn1 * qm.n_syn2, device=device)
     noisy_ans = torch.empty((0,)).float()
     b = torch.ones([qm.n_syn1 * qm.n_syn2]).to(device=device).float() / (qm.n_syn1 * qm.n_syn2)
+    # Q_set @ b for the current b
+    Qb = torch.empty((0,), device=device)
 
     for t in tqdm(range(T)):
 
@@ -56,15 +63,17 @@ def learn_relationship_vector_torch(qm: QueryManagerTorch, epsilon_relationship=
 
             curr_workload = qm.workload_names[i]
 
-            curr_Qmat, curr_true_answer = qm.get_query_mat_full_table(curr_workload)
+            curr_true_answer = qm.get_true_answers(curr_workload)
 
             noisy_curr_ans = GM_torch(curr_true_answer, per_round_rho_rel, n_relationship_orig)
 
             noisy_ans = torch.cat([noisy_ans, noisy_curr_ans])
 
-            Q_set = torch_cat_sparse_coo([Q_set, curr_Qmat], device=device)
+            curr_Qmat = Q_set.append_workload(qm, curr_workload)
+            Qb = torch.cat([Qb, curr_Qmat @ b])
 
-        b = mirror_descent_torch(Q_set, b, noisy_ans, step_size = 0.01, T_mirror=T_mirror)
+        b, Qb = mirror_descent_torch(Q_set, b, noisy_ans.to(device=device), step_size = 0.01, T_mirror=T_mirror,
+                                     tol=mirror_tol, Qb=Qb, return_state=True)
 
     b = b * n_relationship_synt
     b_round = expround_torch(b, device=device)
@@ -1,12 +1,12 @@
 import numpy as np
 import torch
-from ..qm import QueryManager, QueryManagerBasic, QueryManagerTorch
+from ..qm import QueryManager, QueryManagerBasic, QueryManagerTorch, SyntheticAnswerCache
 from ..helpers import cdp_delta, cdp_eps, cdp_rho, get_per_round_privacy_budget, torch_cat_sparse_coo
 
 
 from ..helpers import expround_torch, GM_torch_noise, GM_torch, mosek_optimize, mirror_descent_torch
 from ..helpers import unbiased_sample_torch, unbiased_sample, display_top
-from ..helpers import get_relationships_from_sparse
+from ..helpers import get_relationships_from_sparse, exp_mech_topk, SpectralNormCache, RelationshipSet
 from ..helpers import largest_singular_value, gradient, optimal_project_to_simplex_torch, pgd_optimize
 
 from tqdm import tqdm
@@ -15,13 +15,17 @@ import random
 
 import gc
 
+from concurrent.futures import ThreadPoolExecutor
+
 import time
 
 @torch.no_grad()
 def learn_relationship_vector_torch_pgd(qm: QueryManagerTorch, epsilon_relationship=1.0, T=100,
                                             delta_relationship = 1e-5, subtable_size=100000, queries_to_reuse=None, iter_cb=lambda *args: None,
                                             k_new_queries=3, k_choose_from=300, exp_mech_alpha=0.2, choose_worst=True, verbose=False, device="cpu",
-                                              slices_per_iter=1, guaranteed_rels=0.0, pgd_iters=100):
+                                              slices_per_iter=1, guaranteed_rels=0.0, pgd_iters=100, matrix_free=False,
+                                              exact_step_size=False, parallel_slices=1, pgd_tol=None, pgd_grad_tol=None,
+                                              forward_trace=False):
     """Implementation of new PGD based algorithm
      - Exponential mechanism to choose queries from the set 
      - Unbiased estimator algorithm
@@ -36,6 +40,11 @@ def learn_relationship_vector_torch_pgd(qm: QueryManagerTorch, epsilon_relations
     queries_to_reuse: the number of queries that we will evaluate in each iteration. Set to None to run all.
     k_new_queries: number of new queries to add to our set in each iteration
     k_choose_from: number of queries to evaluate when running the exponential mechanism
+    matrix_free: use a KroneckerQueryOperator instead of materializing the slice query matrix, for large subtable_size
+    exact_step_size: set the PGD step size by power iteration rather than the closed-form spectral norm bound
+    parallel_slices: number of disjoint slices whose PGD solves run concurrently in a thread pool, splitting torch's intra-op threads between them
+    pgd_iters, pgd_tol, pgd_grad_tol: maximum number of PGD steps per slice, and the early stopping tolerances (see pgd_optimize)
+    forward_trace: pass the PGD traces of the slices solved in an iteration to iter_cb, as iter_cb(qm, b_round, t, traces)
     """
     assert k_new_queries <= k_choose_from
     assert 0 < exp_mech_alpha < 1
@@ -75,201 +84,194 @@ def learn_relationship_vector_torch_pgd(qm: QueryManagerTorch, epsilon_relations
     selected_workloads = []
     noisy_ans_list = []
     
-    def get_dataset_answer(workload_idx, table1_idxes, table2_idxes):
-        """ Given a workload index and indexes of columns in both table 1 and table 2,
-         return the true answer and the current answer on the dataset for the workload. """
+    def get_dataset_answer(workload_idx):
+        """ Given a workload index, return the true answer and the current answer on the dataset for the workload. """
         w = qm.workload_names[workload_idx]
-        # load the workload
-        # size: num_queries x (nsyn1*nsyn2)
         true_answer = qm.get_true_answers(w)
-        
-        offsets_t1 = qm.get_offsets(w, 0, is_synth=True)
-        offsets_t2 = qm.get_offsets(w, 1, is_synth=True)
-        
-        offsets = offsets_t1[table1_idxes] + offsets_t2[table2_idxes]
-        values, counts = np.unique(offsets, return_counts=True)
-        
-        dataset_answer = torch.zeros([qm.workload_dict[w]["range_size"]])
-        for val, count in zip(values, counts):
-            dataset_answer[val] = count
-        dataset_answer /= table1_idxes.shape[0]
+        # answers on the current relationship set are maintained incrementally by ans_cache
+        dataset_answer = torch.from_numpy(ans_cache.get_answers(workload_idx)).float()
         return true_answer, dataset_answer
     
     # initialize a b_round vector
     # This must be sparse for memory reasons.
     rand_idxes = torch.randperm(qm.n_syn1 * qm.n_syn2)[None, :n_relationship_synt] # TODO: this may run out of memory
-    b_round = torch.sparse_coo_tensor(indices=rand_idxes, values=torch.ones([n_relationship_synt]),
-                                      size=[qm.n_syn_cross], device=device).float().coalesce()
+    b_round = RelationshipSet(rand_idxes[0].numpy(), qm.n_syn1, qm.n_syn2)
+    ans_cache = SyntheticAnswerCache(qm, *b_round.indices())
+    # step sizes, memoized per (workload set, slice)
+    spectral_norm_cache = SpectralNormCache(exact=exact_step_size)
+    # slices solved concurrently: each needs its own table1 rows
+    max_concurrent_slices = max(1, min(parallel_slices, qm.n_syn1 // table1_slice_size))
     
     for t in tqdm(range(T)):
-        for x_sli in range(slices_per_iter):
-            timers = []
-            timers.append((time.time(), "start"))
-            
-            table1_idxes, table2_idxes = get_relationships_from_sparse(qm, b_round)
+        traces = [] # PGD traces of this iteration's slices, for iter_cb
+        batch_start = 0
+        while batch_start < slices_per_iter:
+            # slices in a batch use disjoint table1 rows, so they cover disjoint cells and can be solved independently
+            batch = range(batch_start, min(batch_start + max_concurrent_slices, slices_per_iter))
+            batch_start = batch.stop
+            used_table1 = torch.empty(0, dtype=torch.long, device=device)
+            prepared_slices = []
             
-            def generate_rand_slice_offsets():
-                # choose random guaranteed indices
-                guaranteed_idxes = torch.randperm(n_relationship_synt)[:num_guaranteed_rels]
-                table1_guaranteed = torch.unique(torch.from_numpy(table1_idxes[guaranteed_idxes]).to(device))
-                table2_guaranteed = torch.unique(torch.from_numpy(table2_idxes[guaranteed_idxes]).to(device))
-                num_t1_guaranteed = torch.numel(table1_guaranteed)
-                num_t2_guaranteed = torch.numel(table2_guaranteed)
-                # choose a set to slice
-                t1_randperm = torch.randperm(qm.n_syn1, device=device)
-                t2_randperm = torch.randperm(qm.n_syn2, device=device)
-                slice_table1_rand = torch.masked_select(t1_randperm, torch.isin(t1_randperm, table1_guaranteed, invert=True))[:(table1_slice_size - num_t1_guaranteed)]
-                slice_table2_rand = torch.masked_select(t2_randperm, torch.isin(t2_randperm, table2_guaranteed, invert=True))[:(table2_slice_size - num_t2_guaranteed)]
-                slice_table1 = torch.cat((table1_guaranteed, slice_table1_rand))
-                slice_table2 = torch.cat((table2_guaranteed, slice_table2_rand))
-                # identify which cells these are in b
-                offsets_table1 = slice_table1.repeat_interleave(table2_slice_size) * qm.n_syn2
-                offsets_table2 = slice_table2.repeat(table1_slice_size)
-                offsets = offsets_table1 + offsets_table2
-                
-                return slice_table1.cpu(), slice_table2.cpu(), offsets
-            
-            slice_table1, slice_table2, offsets = generate_rand_slice_offsets()
-            
-            # we will start optimising from here
-            sub_num_relationships = int(torch.sparse.sum(torch.index_select(b_round, 0, offsets)).numpy(force=True))
-            print(f"ITERATION {t}: Optimizing slice #{x_sli}, has {sub_num_relationships} relationships")
-            if (sub_num_relationships < 1):
-                continue
-            timers.append((time.time(), "assorted_precomps"))
+            # everything that draws random numbers or reads the current relationships runs serially
+            for x_sli in batch:
+                timers = []
+                timers.append((time.time(), "start"))
 
-            # On the first slice, we need to select new workloads.
-            if x_sli == 0:
-                def exp_mech_new_workloads(uselected_workload):
-                    """ Uses the exponential mechanism to select new workloads """
-                    
-                    exp_mech_workload_pool = random.sample(uselected_workload, k=min(k_choose_from, len(uselected_workload)))
-                    
-                    # get answers on this dataset
-                    # if queries are being reused, it makes logical sense to choose worst
-                    # queries on the whole dataset, not just the current slice.
-                    # we should not save the query matrices at this point or we will run out of memory
-                    true_and_dset_answers = [get_dataset_answer(i, table1_idxes, table2_idxes) for i in exp_mech_workload_pool]
-                    
-                    errors = [torch.sum(torch.abs(true_answer - dataset_answer)).numpy(force=True) for true_answer, dataset_answer in true_and_dset_answers]
-                    
-                    new_workloads = []
-                    for x in range(k_new_queries):
-                        if len(errors) == 0:
-                            break
-                        # convert into numpy array
-                        errors_np = np.array(errors)
-                        
-                        # now select from this set using the exponential mechanism
-                        def softmax(v):
-                            v_exp = np.exp(v - np.max(v))
-                            return v_exp / np.sum(v_exp)
-                        distribution = softmax(exp_mech_factor * errors_np)
-                        
-                        # sample from the distribution
-                        def sample(dist):
-                            cumulative_dist = np.cumsum(dist)
-                            r = np.random.rand()
-                            return np.searchsorted(cumulative_dist, r)
-                        new_workload_idx = sample(distribution)
-                        new_workload = exp_mech_workload_pool[new_workload_idx]
-                        new_workloads.append(new_workload)
-                        
-                        # remove the workload from the pool
-                        exp_mech_workload_pool.pop(new_workload_idx)
-                        errors.pop(new_workload_idx) # double check
-                    
-                    return new_workloads
+                table1_idxes, table2_idxes = b_round.indices()
 
-                new_workloads_this_iter = exp_mech_new_workloads(unselected_workload)
-                timers.append((time.time(), "exponential mechanism"))
-                
-                for i in new_workloads_this_iter:
-                    unselected_workload.remove(i)
-                    selected_workloads.append(i)
-                    
-                    workload = qm.workload_names[i]
-                    noisy_ans_list.append(GM_torch_noise(qm.get_true_answers(workload), gm_stddev))
-            
-            # initialize the Q_set from this list
-            Q_set = torch.empty((0, cross_slice_size)).to_sparse_coo().to(device=device).float().coalesce()
-    
-            k_val = len(selected_workloads) if queries_to_reuse is None else min(queries_to_reuse, len(selected_workloads))
-            errors = []
-            
-            timers.append((time.time(), "begin workload eval"))
-            # On each iteration, evaluate all the workloads that we have stored answers for, and keep the ones with the worst errors.
-            # Only optimize the worst k_val workloads
-            for i in range(len(selected_workloads)):
-                workload_idx = selected_workloads[i]
-                _, dataset_ans = get_dataset_answer(workload_idx, table1_idxes, table2_idxes) # we can't actually use the true answer here!
-                true_ans = noisy_ans_list[i]
-                errors.append((torch.sum(torch.abs(true_ans - dataset_ans)).numpy(force=True), i))
-            top_errors = (sorted(errors) if choose_worst else random.sample(errors, len(errors)))[-k_val:]
-            curr_workload_idxes = [i for err, i in top_errors]
-            iter_selected_workloads = [selected_workloads[i] for i in curr_workload_idxes]
-            iter_noisy_ans = torch.cat([noisy_ans_list[i] for i in curr_workload_idxes])
-            timers.append((time.time(), "end workload eval"))
-            
-            # Create the query matrices for the selected workloads
-            for i in iter_selected_workloads:
-                curr_workload = qm.workload_names[i]
-    
-                curr_Qmat, curr_true_answer = qm.get_query_mat_sub_table(curr_workload, slice_table1, slice_table2)
-                # curr_Qmat = torch.index_select(curr_Qmat_full, 1, offsets).coalesce()
-                
-                # del curr_Qmat_full
-    
-                Q_set = torch_cat_sparse_coo([Q_set, curr_Qmat], device=device)
-                
-                del curr_Qmat
-            
-            timers.append((time.time(), "build q mat"))
-            # start with a random guess for b
-            # TODO: think about using Algorithm L: https://en.wikipedia.org/wiki/Reservoir_sampling for this instead
-            b_slice_rand_idxes = torch.randperm(cross_slice_size)[:sub_num_relationships]
-            b_slice_rand_idxes = torch.stack((b_slice_rand_idxes, torch.zeros_like(b_slice_rand_idxes)))
-            
-            b_slice = torch.sparse_coo_tensor(indices=b_slice_rand_idxes, values=torch.ones([sub_num_relationships]),
-                                            size=[cross_slice_size, 1], device=device).float().coalesce()
-            Q_set = Q_set.coalesce()
-            b_slice = pgd_optimize(Q_set, b_slice, iter_noisy_ans.to(device=device), sub_num_relationships, pgd_iters)
-            timers.append((time.time(), "optimizer"))
+                def generate_rand_slice_offsets():
+                    # choose random guaranteed indices
+                    guaranteed_idxes = torch.randperm(n_relationship_synt)[:num_guaranteed_rels]
+                    table1_guaranteed = torch.unique(torch.from_numpy(table1_idxes[guaranteed_idxes]).to(device))
+                    table1_guaranteed = table1_guaranteed[torch.isin(table1_guaranteed, used_table1, invert=True)]
+                    table2_guaranteed = torch.unique(torch.from_numpy(table2_idxes[guaranteed_idxes]).to(device))
+                    num_t1_guaranteed = torch.numel(table1_guaranteed)
+                    num_t2_guaranteed = torch.numel(table2_guaranteed)
+                    # choose a set to slice
+                    t1_randperm = torch.randperm(qm.n_syn1, device=device)
+                    t2_randperm = torch.randperm(qm.n_syn2, device=device)
+                    excluded_table1 = torch.cat((table1_guaranteed, used_table1))
+                    slice_table1_rand = torch.masked_select(t1_randperm, torch.isin(t1_randperm, excluded_table1, invert=True))[:(table1_slice_size - num_t1_guaranteed)]
+                    slice_table2_rand = torch.masked_select(t2_randperm, torch.isin(t2_randperm, table2_guaranteed, invert=True))[:(table2_slice_size - num_t2_guaranteed)]
+                    slice_table1 = torch.cat((table1_guaranteed, slice_table1_rand))
+                    slice_table2 = torch.cat((table2_guaranteed, slice_table2_rand))
+                    # identify which cells these are in b
+                    offsets_table1 = slice_table1.repeat_interleave(table2_slice_size) * qm.n_syn2
+                    offsets_table2 = slice_table2.repeat(table1_slice_size)
+                    offsets = offsets_table1 + offsets_table2
+
+                    return slice_table1.cpu(), slice_table2.cpu(), offsets
+
+                slice_table1, slice_table2, offsets = generate_rand_slice_offsets()
+
+                # we will start optimising from here
+                offsets_np = offsets.cpu().numpy()
+                sub_num_relationships = b_round.count_in(offsets_np)
+                print(f"ITERATION {t}: Optimizing slice #{x_sli}, has {sub_num_relationships} relationships")
+                if (sub_num_relationships < 1):
+                    continue
+                timers.append((time.time(), "assorted_precomps"))
+
+                # On the first slice, we need to select new workloads.
+                if x_sli == 0:
+                    def exp_mech_new_workloads(uselected_workload):
+                        """ Uses the exponential mechanism to select new workloads """
+
+                        exp_mech_workload_pool = random.sample(uselected_workload, k=min(k_choose_from, len(uselected_workload)))
+
+                        # get answers on this dataset
+                        # if queries are being reused, it makes logical sense to choose worst
+                        # queries on the whole dataset, not just the current slice.
+                        # we should not save the query matrices at this point or we will run out of memory
+                        # L1 errors of every candidate, scored in one vectorized pass over the answer cache
+                        errors = ans_cache.workload_errors(qm.true_ans_vec, exp_mech_workload_pool)
+
+                        # sample k_new_queries workloads without replacement using the exponential mechanism
+                        chosen = exp_mech_topk(exp_mech_factor * errors, k_new_queries)
+                        new_workloads = [exp_mech_workload_pool[i] for i in chosen]
+
+                        return new_workloads
+
+                    new_workloads_this_iter = exp_mech_new_workloads(unselected_workload)
+                    timers.append((time.time(), "exponential mechanism"))
+
+                    for i in new_workloads_this_iter:
+                        unselected_workload.remove(i)
+                        selected_workloads.append(i)
+
+                        workload = qm.workload_names[i]
+                        noisy_ans_list.append(GM_torch_noise(qm.get_true_answers(workload), gm_stddev))
+
+                k_val = len(selected_workloads) if queries_to_reuse is None else min(queries_to_reuse, len(selected_workloads))
+                errors = []
+
+                timers.append((time.time(), "begin workload eval"))
+                # On each iteration, evaluate all the workloads that we have stored answers for, and keep the ones with the worst errors.
+                # Only optimize the worst k_val workloads
+                for i in range(len(selected_workloads)):
+                    workload_idx = selected_workloads[i]
+                    _, dataset_ans = get_dataset_answer(workload_idx) # we can't actually use the true answer here!
+                    true_ans = noisy_ans_list[i]
+                    errors.append((torch.sum(torch.abs(true_ans - dataset_ans)).numpy(force=True), i))
+                top_errors = (sorted(errors) if choose_worst else random.sample(errors, len(errors)))[-k_val:]
+                curr_workload_idxes = [i for err, i in top_errors]
+                iter_selected_workloads = [selected_workloads[i] for i in curr_workload_idxes]
+                iter_noisy_ans = torch.cat([noisy_ans_list[i] for i in curr_workload_idxes])
+                timers.append((time.time(), "end workload eval"))
+
+                # Create the query matrices for the selected workloads
+                # built directly in CSR form, one nonzero per column per workload, or left matrix-free
+                build_query_mat = qm.get_query_operator_sub_table if matrix_free else qm.get_query_mat_sub_table_stacked
+                Q_set, _ = build_query_mat([qm.workload_names[i] for i in iter_selected_workloads], slice_table1, slice_table2)
+
+                timers.append((time.time(), "build q mat"))
+                # start with a random guess for b
+                # TODO: think about using Algorithm L: https://en.wikipedia.org/wiki/Reservoir_sampling for this instead
+                b_slice_rand_idxes = torch.randperm(cross_slice_size)[:sub_num_relationships]
+
+                b_slice = torch.zeros([cross_slice_size, 1], device=device)
+                b_slice[b_slice_rand_idxes.to(device), 0] = 1
+                spectral_norm = spectral_norm_cache.get(Q_set, iter_selected_workloads, slice_table1, slice_table2)
+
+                used_table1 = torch.cat((used_table1, slice_table1.to(device)))
+                prepared_slices.append((timers, offsets_np, sub_num_relationships, Q_set, b_slice,
+                                        iter_noisy_ans.to(device=device), spectral_norm))
             
-            # put these back into the slice: this is slightly complicated!
-            b_slice_round = unbiased_sample_torch(torch.squeeze(b_slice), m=sub_num_relationships, device=device)
-            timers.append((time.time(), "sample"))
-            b_slice_round = b_slice_round.to_sparse()
+            # only the PGD solves run concurrently; the workloads and noisy answers are shared read-only
+            def solve_slice(prepared):
+                _, _, sub_num_relationships, Q_set, b_slice, iter_noisy_ans, spectral_norm = prepared
+                return pgd_optimize(Q_set, b_slice, iter_noisy_ans, sub_num_relationships, pgd_iters,
+                                    spectral_norm=spectral_norm, tol=pgd_tol, grad_tol=pgd_grad_tol, return_trace=forward_trace)
+            if len(prepared_slices) < 2:
+                solved_slices = [solve_slice(prepared) for prepared in prepared_slices]
+            else:
+                # each solve gets an equal share of torch's intra-op threads, so the pool does not
+                # oversubscribe the CPU; fresh worker threads pick up the reduced thread count
+                num_threads = torch.get_num_threads()
+                torch.set_num_threads(max(1, num_threads // len(prepared_slices)))
+                try:
+                    with ThreadPoolExecutor(max_workers=len(prepared_slices)) as executor:
+                        solved_slices = list(executor.map(solve_slice, prepared_slices))
+                finally:
+                    torch.set_num_threads(num_threads)
             
-            # create a mask
-            mask = torch.sparse_coo_tensor(offsets[None, :], torch.ones_like(offsets), size=[qm.n_syn_cross], device=device).coalesce()
-            b_round.coalesce()
-            b_round = b_round - (mask * b_round) # now the area is filled with zeros
-            # get nonzero indices in b_slice_round
-            nz_indices = torch.squeeze(b_slice_round.indices())
-            # lookup what offsets these were in the original tensor
-            new_offsets = offsets[nz_indices]
-            # print(new_offsets)
-            # create new values
-            new_values = torch.sparse_coo_tensor(new_offsets[None, :], torch.ones_like(new_offsets), size=[qm.n_syn_cross], device=device).coalesce()
-            b_round = b_round + new_values
-            timers.append((time.time(), "reinsert"))
+            # merge the solutions back in slice order, so the result does not depend on thread scheduling
+            for (timers, offsets_np, sub_num_relationships, *_), b_slice in zip(prepared_slices, solved_slices):
+                if forward_trace:
+                    b_slice, trace = b_slice
+                    traces.append(trace)
+                timers.append((time.time(), "optimizer"))
+                # put these back into the slice: this is slightly complicated!
+                b_slice_round = unbiased_sample_torch(torch.squeeze(b_slice), m=sub_num_relationships, device=device)
+                timers.append((time.time(), "sample"))
+
+                # relationships currently inside the slice are replaced by the rounded ones
+                removed_offsets = b_round.cells_in(offsets_np)
+                # lookup what offsets the nonzero entries of b_slice_round were in the original tensor
+                nz_indices = torch.nonzero(b_slice_round).squeeze(1)
+                new_offsets = offsets_np[nz_indices.cpu().numpy()]
+                b_round.remove(removed_offsets)
+                b_round.insert(new_offsets)
+                # apply the changed relationships to the answer cache
+                ans_cache.remove(removed_offsets // qm.n_syn2, removed_offsets % qm.n_syn2)
+                ans_cache.add(new_offsets // qm.n_syn2, new_offsets % qm.n_syn2)
+                timers.append((time.time(), "reinsert"))
+
+                # print(timers)
+                timers_processed = [(int((timtup[0] - timers[i][0]) * 100000) / 100000, timtup[1]) for i, timtup in enumerate(timers[1:])]
+                # print(f"slice {x_sli}")
+                # print(timers_processed)
             
             # clean TODO: is this necessary?
-            del slice_table1
-            del slice_table2
-            del offsets
-            del mask
-            del Q_set
+            del prepared_slices
+            del solved_slices
             gc.collect()
             if device.type == 'cuda':
                 torch.cuda.empty_cache()
-            
-            # print(timers)
-            timers_processed = [(int((timtup[0] - timers[i][0]) * 100000) / 100000, timtup[1]) for i, timtup in enumerate(timers[1:])]
-            # print(f"slice {x_sli}")
-            # print(timers_processed)
         
-        iter_cb(qm, b_round, t)
+        if forward_trace:
+            iter_cb(qm, b_round, t, traces)
+        else:
+            iter_cb(qm, b_round, t)
     
-    return b_round
+    return b_round.to_sparse(device=device)
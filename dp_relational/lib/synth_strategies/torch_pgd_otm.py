@@ -1,12 +1,12 @@
 import numpy as np
 import torch
-from ..qm import QueryManager, QueryManagerBasic, QueryManagerTorch
+from ..qm import QueryManager, QueryManagerBasic, QueryManagerTorch, SyntheticAnswerCache
 from ..helpers import cdp_delta, cdp_eps, cdp_rho, get_per_round_privacy_budget, torch_cat_sparse_coo
 
 
 from ..helpers import expround_torch, GM_torch_noise, GM_torch, mosek_optimize, mirror_descent_torch
 from ..helpers import unbiased_sample_torch, unbiased_sample, display_top
-from ..helpers import get_relationships_from_sparse
+from ..helpers import get_relationships_from_sparse, exp_mech_topk, SpectralNormCache, RelationshipSet
 from ..helpers import largest_singular_value, gradient, projsplx_torch, one_to_many_project, one_to_many_sample, pgd_optimize_one_to_many
 
 from tqdm import tqdm
@@ -21,7 +21,9 @@ import time
 def learn_relationship_vector_torch_pgd_otm(qm: QueryManagerTorch, epsilon_relationship=1.0, T=100,
                                             delta_relationship = 1e-5, subtable_size=100000, queries_to_reuse=None, iter_cb=lambda *args: None,
                                             k_new_queries=3, k_choose_from=300, exp_mech_alpha=0.2, choose_worst=True, verbose=False, device="cpu",
-                                              slices_per_iter=1, expansion_ratio=2.5):
+                                              slices_per_iter=1, expansion_ratio=2.5, matrix_free=False,
+                                              exact_step_size=False, pgd_iters=20, pgd_tol=None, pgd_grad_tol=None,
+                                              forward_trace=False):
     """Implementation of new PGD based algorithm
      - Exponential mechanism to choose queries from the set 
      - Unbiased estimator algorithm
@@ -36,6 +38,10 @@ def learn_relationship_vector_torch_pgd_otm(qm: QueryManagerTorch, epsilon_relat
     queries_to_reuse: the number of queries that we will evaluate in each iteration. Set to None to run all.
     k_new_queries: number of new queries to add to our set in each iteration
     k_choose_from: number of queries to evaluate when running the exponential mechanism
+    matrix_free: use a KroneckerQueryOperator instead of materializing the slice query matrix, for large subtable_size
+    exact_step_size: set the PGD step size by power iteration rather than the closed-form spectral norm bound
+    pgd_iters, pgd_tol, pgd_grad_tol: maximum number of PGD steps per slice, and the early stopping tolerances (see pgd_optimize)
+    forward_trace: pass the PGD traces of the slices solved in an iteration to iter_cb, as iter_cb(qm, b_round, t, traces)
 
     This algorithm enforces a one to many relationship. This is also NOT TESTED!
     """
@@ -78,38 +84,29 @@ def learn_relationship_vector_torch_pgd_otm(qm: QueryManagerTorch, epsilon_relat
     selected_workloads = []
     noisy_ans_list = []
     
-    def get_dataset_answer(workload_idx, table1_idxes, table2_idxes):
-        """ Given a workload index and indexes of columns in both table 1 and table 2,
-         return the current answer on the dataset for the workload. """
+    def get_dataset_answer(workload_idx):
+        """ Given a workload index, return the current answer on the dataset for the workload. """
         w = qm.workload_names[workload_idx]
-        # load the workload
-        # size: num_queries x (nsyn1*nsyn2)
         true_answer = qm.get_true_answers(w)
-        
-        offsets_t1 = qm.get_offsets(w, 0, is_synth=True)
-        offsets_t2 = qm.get_offsets(w, 1, is_synth=True)
-        
-        offsets = offsets_t1[table1_idxes] + offsets_t2[table2_idxes]
-        values, counts = np.unique(offsets, return_counts=True)
-        
-        dataset_answer = torch.zeros([qm.workload_dict[w]["range_size"]])
-        for val, count in zip(values, counts):
-            dataset_answer[val] = count
-        dataset_answer /= table1_idxes.shape[0]
+        # answers on the current relationship set are maintained incrementally by ans_cache
+        dataset_answer = torch.from_numpy(ans_cache.get_answers(workload_idx)).float()
         return true_answer, dataset_answer
     
     # initialize a b_round vector
     rand_idxes = torch.randint(0, qm.n_syn2, (qm.n_syn1,)) + torch.arange(0, qm.n_syn2 * qm.n_syn1, qm.n_syn2)[None, :] # torch.randperm(qm.n_syn1 * qm.n_syn2)[None, :n_relationship_synt] # TODO: this may run out of memory
-    b_round = torch.sparse_coo_tensor(indices=rand_idxes, values=torch.ones([n_relationship_synt]),
-                                      size=[qm.n_syn_cross], device=device).float().coalesce()
+    b_round = RelationshipSet(rand_idxes[0].numpy(), qm.n_syn1, qm.n_syn2)
+    ans_cache = SyntheticAnswerCache(qm, *b_round.indices())
+    # step sizes, memoized per (workload set, slice)
+    spectral_norm_cache = SpectralNormCache(exact=exact_step_size)
     
     for t in tqdm(range(T)):
+        traces = [] # PGD traces of this iteration's slices, for iter_cb
         # Multiple slices
         for x_sli in range(slices_per_iter):
             timers = []
             timers.append((time.time(), "start"))
             
-            table1_idxes, table2_idxes = get_relationships_from_sparse(qm, b_round)
+            table1_idxes, table2_idxes = b_round.indices()
             
             def generate_rand_slice_offsets():
                 # choose random guaranteed indices
@@ -133,7 +130,8 @@ def learn_relationship_vector_torch_pgd_otm(qm: QueryManagerTorch, epsilon_relat
             slice_table1, slice_table2, offsets = generate_rand_slice_offsets()
             
             # we will start optimising from here
-            sub_num_relationships = int(torch.sparse.sum(torch.index_select(b_round, 0, offsets)).numpy(force=True))
+            offsets_np = offsets.cpu().numpy()
+            sub_num_relationships = b_round.count_in(offsets_np)
             print(sub_num_relationships)
             if (sub_num_relationships < 1):
                 continue
@@ -150,33 +148,12 @@ def learn_relationship_vector_torch_pgd_otm(qm: QueryManagerTorch, epsilon_relat
                     # if queries are being reused, it makes logical sense to choose worst
                     # queries on the whole dataset, not just the current slice.
                     # we should not save the query matrices at this point or we will run out of memory
-                    true_and_dset_answers = [get_dataset_answer(i, table1_idxes, table2_idxes) for i in exp_mech_workload_pool]
+                    # L1 errors of every candidate, scored in one vectorized pass over the answer cache
+                    errors = ans_cache.workload_errors(qm.true_ans_vec, exp_mech_workload_pool)
                     
-                    errors = [torch.sum(torch.abs(true_answer - dataset_answer)).numpy(force=True) for true_answer, dataset_answer in true_and_dset_answers]
-                    
-                    new_workloads = []
-                    for x in range(k_new_queries):
-                        # convert into numpy array
-                        errors_np = np.array(errors)
-                        
-                        # now select from this set using the exponential mechanism
-                        def softmax(v):
-                            v_exp = np.exp(v - np.max(v))
-                            return v_exp / np.sum(v_exp)
-                        distribution = softmax(exp_mech_factor * errors_np)
-                        
-                        # sample from the distribution
-                        def sample(dist):
-                            cumulative_dist = np.cumsum(dist)
-                            r = np.random.rand()
-                            return np.searchsorted(cumulative_dist, r)
-                        new_workload_idx = sample(distribution)
-                        new_workload = exp_mech_workload_pool[new_workload_idx]
-                        new_workloads.append(new_workload)
-                        
-                        # remove the workload from the pool
-                        exp_mech_workload_pool.pop(new_workload_idx)
-                        errors.pop(new_workload_idx) # double check
+                    # sample k_new_queries workloads without replacement using the exponential mechanism
+                    chosen = exp_mech_topk(exp_mech_factor * errors, k_new_queries)
+                    new_workloads = [exp_mech_workload_pool[i] for i in chosen]
                     
                     return new_workloads
                 
@@ -190,9 +167,6 @@ def learn_relationship_vector_torch_pgd_otm(qm: QueryManagerTorch, epsilon_relat
                     workload = qm.workload_names[i]
                     noisy_ans_list.append(GM_torch_noise(qm.get_true_answers(workload), gm_stddev))
             
-            # initialize the Q_set from this list
-            Q_set = torch.empty((0, cross_slice_size)).to_sparse_coo().to(device=device).float().coalesce()
-    
             k_val = len(selected_workloads) if queries_to_reuse is None else min(queries_to_reuse, len(selected_workloads))
             errors = []
             
@@ -200,7 +174,7 @@ def learn_relationship_vector_torch_pgd_otm(qm: QueryManagerTorch, epsilon_relat
             # On each iteration, evaluate all the workloads that we have stored answers for, and keep the ones with the worst errors.
             for i in range(len(selected_workloads)):
                 workload_idx = selected_workloads[i]
-                _, dataset_ans = get_dataset_answer(workload_idx, table1_idxes, table2_idxes) # we can't actually use the true answer here!
+                _, dataset_ans = get_dataset_answer(workload_idx) # we can't actually use the true answer here!
                 true_ans = noisy_ans_list[i]
                 errors.append((torch.sum(torch.abs(true_ans - dataset_ans)).numpy(force=True), i))
             top_errors = (sorted(errors) if choose_worst else random.sample(errors, len(errors)))[-k_val:]
@@ -210,58 +184,50 @@ def learn_relationship_vector_torch_pgd_otm(qm: QueryManagerTorch, epsilon_relat
             timers.append((time.time(), "end workload eval"))
             
             # Get the query matrices for these workloads
-            for i in iter_selected_workloads:
-                curr_workload = qm.workload_names[i]
-    
-                curr_Qmat, curr_true_answer = qm.get_query_mat_sub_table(curr_workload, slice_table1, slice_table2)
-                # curr_Qmat = torch.index_select(curr_Qmat_full, 1, offsets).coalesce()
-                
-                # del curr_Qmat_full
-    
-                Q_set = torch_cat_sparse_coo([Q_set, curr_Qmat], device=device)
-                
-                del curr_Qmat
+            # built directly in CSR form, one nonzero per column per workload, or left matrix-free
+            build_query_mat = qm.get_query_operator_sub_table if matrix_free else qm.get_query_mat_sub_table_stacked
+            Q_set, _ = build_query_mat([qm.workload_names[i] for i in iter_selected_workloads], slice_table1, slice_table2)
             
             timers.append((time.time(), "build q mat"))
             # start with a random guess for b
             # TODO: think about using Algorithm L: https://en.wikipedia.org/wiki/Reservoir_sampling for this instead
             b_slice_rand_idxes = torch.randint(0, table2_slice_size, (table1_slice_size,)) + torch.arange(0, table2_slice_size * table1_slice_size, table2_slice_size)
-            b_slice_rand_idxes = torch.stack((b_slice_rand_idxes, torch.zeros_like(b_slice_rand_idxes)))
             
-            b_slice = torch.sparse_coo_tensor(indices=b_slice_rand_idxes, values=torch.ones([sub_num_relationships]),
-                                            size=[cross_slice_size, 1], device=device).float().coalesce()
-            Q_set = Q_set.coalesce()
+            b_slice = torch.zeros([cross_slice_size, 1], device=device)
+            b_slice[b_slice_rand_idxes.to(device), 0] = 1
             
             # run pgd.
             # The one to many function also enforces the one-to-many constraint in the projection.
-            b_slice = pgd_optimize_one_to_many(Q_set, b_slice, iter_noisy_ans.to(device=device), sub_num_relationships, 20, table2_slice_size)
+            spectral_norm = spectral_norm_cache.get(Q_set, iter_selected_workloads, slice_table1, slice_table2)
+            b_slice = pgd_optimize_one_to_many(Q_set, b_slice, iter_noisy_ans.to(device=device), sub_num_relationships, pgd_iters, table2_slice_size,
+                                               spectral_norm=spectral_norm, tol=pgd_tol, grad_tol=pgd_grad_tol,
+                                               return_trace=forward_trace)
+            if forward_trace:
+                b_slice, trace = b_slice
+                traces.append(trace)
             
             timers.append((time.time(), "optimizer"))
             
             # put these back into the slice: this is slightly complicated!
-            b_slice_round = one_to_many_sample(torch.squeeze(b_slice), table2_slice_size).to(device)
+            b_slice_round = one_to_many_sample(torch.squeeze(b_slice), table2_slice_size)
             timers.append((time.time(), "sample"))
-            b_slice_round = b_slice_round.to_sparse()
             
-            # create a mask
-            mask = torch.sparse_coo_tensor(offsets[None, :], torch.ones_like(offsets), size=[qm.n_syn_cross], device=device).coalesce()
-            b_round.coalesce()
-            b_round = b_round - (mask * b_round) # now the area is filled with zeros
-            # get nonzero indices in b_slice_round
-            nz_indices = torch.squeeze(b_slice_round.indices())
-            # lookup what offsets these were in the original tensor
-            new_offsets = offsets[nz_indices]
-            # print(new_offsets)
-            # create new values
-            new_values = torch.sparse_coo_tensor(new_offsets[None, :], torch.ones_like(new_offsets), size=[qm.n_syn_cross], device=device).coalesce()
-            b_round = b_round + new_values
+            # relationships currently inside the slice are replaced by the rounded ones
+            removed_offsets = b_round.cells_in(offsets_np)
+            # lookup what offsets the nonzero entries of b_slice_round were in the original tensor
+            nz_indices = b_slice_round.indices()[0]
+            new_offsets = offsets_np[nz_indices.cpu().numpy()]
+            b_round.remove(removed_offsets)
+            b_round.insert(new_offsets)
+            # apply the changed relationships to the answer cache
+            ans_cache.remove(removed_offsets // qm.n_syn2, removed_offsets % qm.n_syn2)
+            ans_cache.add(new_offsets // qm.n_syn2, new_offsets % qm.n_syn2)
             timers.append((time.time(), "reinsert"))
             
             # clean TODO: is this necessary?
             del slice_table1
             del slice_table2
             del offsets
-            del mask
             del Q_set
             gc.collect()
             if device.type == 'cuda':
@@ -272,6 +238,9 @@ def learn_relationship_vector_torch_pgd_otm(qm: QueryManagerTorch, epsilon_relat
             # print(f"slice {x_sli}")
             # print(timers_processed)
         
-        iter_cb(qm, b_round, t)
+        if forward_trace:
+            iter_cb(qm, b_round, t, traces)
+        else:
+            iter_cb(qm, b_round, t)
     
-    return b_round
+    return b_round.to_sparse(device=device)
@@ -46,20 +46,17 @@ def make_summary_dict():
     }
 
 def cross_generator_torch(qm, eps_rel, T):
+    # qm.device is the device assigned to this sweep worker
     b_round = dp_relational.lib.synth_data.learn_relationship_vector_torch_pgd_otm(qm, eps_rel, T=Tconst,
-                subtable_size=1000000, verbose=True, device=device, queries_to_reuse=q_reuse,
+                subtable_size=1000000, verbose=True, device=torch.device(qm.device), queries_to_reuse=q_reuse,
                 exp_mech_alpha=alpha, k_new_queries=k_new, choose_worst=worst, slices_per_iter=3, expansion_ratio=2
             )
     print(make_summary_dict())
     relationship_syn = dp_relational.lib.synth_data.make_synthetic_rel_table_sparse(qm, b_round)
     return relationship_syn
 
-runner = ModelRunner(self_relation=False)
-
-runner.update(dataset_generator=lambda dmax: dp_relational.data.ipums_otm.dataset(dmax, frac=fraction), n_syn1=table_size, n_syn2=table_size,
-              synth='mst', epsilon=4.0, eps1=1.0, eps2=1.0, k=3, dmax=8, T=Tconst,
-              qm_generator=qm_generator_torch, cross_generation_strategy=cross_generator_torch)
-runner.load_artifacts('5ec5706e-7fff-11ef-b42f-bae7b799ac02')
+def dataset_generator(dmax):
+    return dp_relational.data.ipums_otm.dataset(dmax, frac=fraction)
 
 epsilons = [2.01, 2.1, 2.25, 2.5, 2.75, 3.0]
 #alphas = [0.00001, 0.2, 0.5, 0.8, 0.99999]
@@ -70,15 +67,26 @@ run_count = 0
 #synth_strats = ['mst', 'aim']
 #worsts = [True, False]
 #Ts = [0, 1, 5, 10, 15, 25, 50]
-for loops in range(10):
-    #reset_runner()
-    for eps in epsilons:
-        # synth_strat = sn
-        runner.update(epsilon=eps)
-        runner.regenerate_qm = True
-        runner.regenerate_cross_answers = True
-        results = runner.run(extra_params={ "info": make_summary_dict(), "run_set": "0" })
-        run_count += 1
-        print(runner.rel_dataset_runid, runner.synth_tables_runid, runner.relationship_syn_runid)
-        print(f"eps: {runner.epsilon}, error_ave: {results['error_ave']}")
-        print(f"###### COMPLETED {run_count} RUNS ######")
+NUM_LOOPS = 10
+NUM_PROCESSES = len(epsilons)
+# on GPU, one sweep worker per device: a copy of the PGD state per epsilon would not fit on one GPU
+DEVICES = [torch.device(f"cuda:{i}") for i in range(torch.cuda.device_count())] if device.type == "cuda" else None
+
+def print_result(point, results):
+    global run_count
+    run_count += 1
+    print(results["artifacts"])
+    print(f"eps: {point['epsilon']}, error_ave: {results['error_ave']}")
+    print(f"###### COMPLETED {run_count} RUNS ######")
+
+# spawned sweep workers re-import this script, so the runner is only built in the main process
+if __name__ == "__main__":
+    runner = ModelRunner(self_relation=False)
+    
+    runner.update(dataset_generator=dataset_generator, n_syn1=table_size, n_syn2=table_size,
+                  synth='mst', epsilon=4.0, eps1=1.0, eps2=1.0, k=3, dmax=8, T=Tconst,
+                  qm_generator=qm_generator_torch, cross_generation_strategy=cross_generator_torch)
+    runner.load_artifacts('5ec5706e-7fff-11ef-b42f-bae7b799ac02')
+    
+    runner.sweep([{"epsilon": eps} for loops in range(NUM_LOOPS) for eps in epsilons], processes=NUM_PROCESSES,
+                 devices=DEVICES, extra_params={ "info": make_summary_dict(), "run_set": "0" }, on_result=print_result)